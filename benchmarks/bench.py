@@ -0,0 +1,350 @@
+#!/usr/bin/python3
+'''
+Benchmarks for the hot paths of codegen: Token.find, Schema.value (also on a
+Lazy_Schema), glob expansion (also with a Glob_Index), Compiler.compile (also
+with generated code and with a Render_Cache) and an end-to-end Project.update
+(also restoring the outputs from an Output_Cache).
+
+Synthetic schemas and templates are generated in a temporary directory, their
+size is configurable:
+
+    --fields=N      fields per schema level
+    --depth=N       nesting depth of the schema
+    --density=N     tokens per template line
+    --fanout=N      number of @@ includes per template
+    --schemas=N     number of schemas in the synthetic glob project
+    --repeat=N      timed repetitions per benchmark
+
+The results are written as JSON (to stdout or --output=FILE). Given
+--baseline=FILE the medians are compared with a previously saved result and
+the script exits with 1 when a benchmark is more than --threshold (a
+fraction, 0.1 by default) slower than the baseline:
+
+    python3 benchmarks/bench.py --output=baseline.json
+    python3 benchmarks/bench.py --baseline=baseline.json
+'''
+
+import argparse
+import glob
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import codegen  # noqa: E402
+
+VERSION = 1
+
+
+class Synthetic(object):
+    """Generates synthetic schemas and templates in a directory."""
+    def __init__(self, directory, fields, depth, density, fanout):
+        self.directory = directory
+        self.fields = fields
+        self.depth = depth
+        self.density = density
+        self.fanout = fanout
+
+    def schema(self, index=0):
+        """Gets the json of a schema with nested field lists."""
+        def level(depth):
+            node = {
+                "name": "level{}".format(depth),
+                "flag": depth % 2 == 0,
+                "fields": [{
+                    "name": "field{}".format(i),
+                    "type": "int" if i % 2 else "std::string",
+                    "doc": {"brief": "Field {} of level {}".format(i, depth)}
+                } for i in range(self.fields)]
+            }
+            if depth < self.depth:
+                node["child"] = level(depth + 1)
+            return node
+
+        return {"class": {"name": "class{}".format(index)},
+                "root": level(0)}
+
+    def line(self, prefix="$$"):
+        """Gets a template line with the configured token density."""
+        tokens = ["$$.name", "$$.type", "$$.doc.brief", "!!.class.name"]
+        return " ".join(tokens[i % len(tokens)].replace("$$", prefix, 1)
+                        for i in range(self.density)) + "\n"
+
+    def template(self):
+        """Gets a template looping over the fields of every level."""
+        lines = ["// !!.class.name\n"]
+        lines += ["@@.includes.include{}\n".format(i)
+                  for i in range(self.fanout)]
+        path = "!!.root"
+        for __ in range(self.depth + 1):
+            lines.append(path + ".fields{{\n" + self.line() + "}}\n")
+            path += ".child"
+        return "".join(lines)
+
+    def include(self, index):
+        """Gets the content of an include template."""
+        return "// include {}: !!.class.name !!.root.name\n".format(index)
+
+    def write(self, schemas):
+        """Writes the schemas, templates and a glob project. Returns the path
+        of the project file."""
+        for directory in ("schemas", "templates", "includes"):
+            os.makedirs(os.path.join(self.directory, directory),
+                        exist_ok=True)
+        for i in range(schemas):
+            self._write(os.path.join("schemas", "schema{}.json".format(i)),
+                        json.dumps(self.schema(i), indent=4))
+        self._write(os.path.join("templates", "class.h"), self.template())
+        for i in range(self.fanout):
+            self._write(os.path.join("includes",
+                                     "include{}.template".format(i)),
+                        self.include(i))
+        self._write("project.json", json.dumps({"output": [{
+            "schema": "schemas/*.json",
+            "template": "templates/*.h",
+            "out": "build/$$.class.name...h"
+        }]}, indent=4))
+        return os.path.join(self.directory, "project.json")
+
+    def _write(self, path, contents):
+        with open(os.path.join(self.directory, path), "w") as file:
+            file.write(contents)
+
+
+class Bench(object):
+    """Times benchmarks and collects their results."""
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = {}
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def run(self, name, func, setup=None, number=1):
+        """Times func, calling setup (untimed) before every repetition."""
+        times = []
+        for __ in range(self.repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            for __ in range(number):
+                func()
+            times.append((time.perf_counter() - start) / number)
+        self.results[name] = {
+            "min": min(times),
+            "median": statistics.median(times),
+            "max": max(times),
+            "repeat": self.repeat,
+            "number": number
+        }
+        self.log.info("%-28s median %.6fs", name,
+                      self.results[name]["median"])
+
+
+def run_benchmarks(args):
+    """Runs all benchmarks, returns the results."""
+    bench = Bench(args.repeat)
+    owd = os.getcwd()
+    directory = tempfile.mkdtemp(prefix="codegen-bench-")
+    cache = codegen.Template_Cache.default()
+    outputs = codegen.Output_Cache.default()
+    try:
+        synthetic = Synthetic(directory, args.fields, args.depth,
+                              args.density, args.fanout)
+        project_path = synthetic.write(args.schemas)
+        cache.set_directory(os.path.join(directory, ".codegen-cache"))
+        os.chdir(directory)
+
+        template = codegen.File(os.path.join("templates", "class.h"))
+        content = template.read()
+
+        def find_tokens():
+            token = codegen.Token.find(content)
+            while token is not None:
+                token = codegen.Token.find(content, token.end)
+
+        def lex_tokens():
+            lexer = codegen.Token_Lexer(content)
+            token = lexer.find()
+            while token is not None:
+                token = lexer.find(token.end)
+
+        bench.run("token.find", find_tokens, number=10)
+        bench.run("token.lexer", lex_tokens, number=10)
+
+        schema = codegen.Schema(os.path.join("schemas", "schema0.json"))
+        schema.update()
+        paths = []
+        path = ["root"]
+        for __ in range(args.depth + 1):
+            paths += [path + ["fields", i, "doc", "brief"]
+                      for i in range(args.fields)]
+            path = path + ["child"]
+        bench.run("schema.value", lambda: [schema.value(list(path))
+                                           for path in paths], number=10)
+        lazy = codegen.Lazy_Schema(os.path.join("schemas", "schema0.json"))
+        lazy.update()
+        bench.run("schema.value.lazy", lambda: [lazy.value(list(path))
+                                                for path in paths], number=10)
+        lazy.close()
+
+        patterns = [os.path.join("schemas", "*.json"),
+                    os.path.join("**", "*.h")]
+        globs = codegen.Glob_Index()
+
+        def expand_index():
+            globs.begin_run()
+            for pattern in patterns:
+                globs.glob(pattern)
+
+        bench.run("glob.glob", lambda: [glob.glob(pattern, recursive=True)
+                                        for pattern in patterns], number=10)
+        bench.run("glob.index", expand_index, number=10)
+
+        def clear_cache():
+            shutil.rmtree(os.path.join(directory, ".codegen-cache"), True)
+            cache.clear()
+
+        bench.run("compiler.compile.cold",
+                  lambda: codegen.Compiler(schema).compile(template),
+                  setup=clear_cache)
+        bench.run("compiler.compile.warm",
+                  lambda: codegen.Compiler(schema).compile(template),
+                  number=5)
+        code = codegen.Template_Cache()
+        code.set_compiled()
+        bench.run("compiler.compile.code",
+                  lambda: codegen.Compiler(schema, code).compile(template),
+                  number=5)
+        renders = codegen.Render_Cache.default()
+        renders.set_max_size(codegen.Render_Cache.MAX_SIZE)
+        bench.run("compiler.compile.render",
+                  lambda: codegen.Compiler(schema).compile(template),
+                  number=5)
+        renders.set_max_size(0)
+
+        def clean_project():
+            shutil.rmtree(os.path.join(directory, "build"), True)
+            clear_cache()
+
+        bench.run("project.update.full",
+                  lambda: codegen.Project(project_path).update(),
+                  setup=clean_project)
+        bench.run("project.update.noop",
+                  lambda: codegen.Project(project_path).update())
+
+        outputs.set_directory(os.path.join(directory, ".codegen-outputs"))
+        clean_project()
+        codegen.Project(project_path).update()
+        bench.run("project.update.restore",
+                  lambda: codegen.Project(project_path).update(),
+                  setup=clean_project)
+        outputs.set_directory(None)
+
+        examples = os.path.join(directory, "examples")
+        shutil.copytree(os.path.join(ROOT, "examples"), examples)
+        glob_project = os.path.join(examples, "library_cpp_glob.json")
+        with open(glob_project, "r") as file:
+            contents = file.read().replace("../build/", "build/")
+        with open(glob_project, "w") as file:
+            file.write(contents)
+
+        def clean_examples():
+            shutil.rmtree(os.path.join(examples, "build"), True)
+            clear_cache()
+
+        bench.run("project.update.examples",
+                  lambda: codegen.Project(glob_project).update(),
+                  setup=clean_examples)
+    finally:
+        os.chdir(owd)
+        cache.set_directory(None)
+        cache.clear()
+        outputs.set_directory(None)
+        shutil.rmtree(directory, True)
+
+    return {
+        "version": VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {
+            "fields": args.fields,
+            "depth": args.depth,
+            "density": args.density,
+            "fanout": args.fanout,
+            "schemas": args.schemas,
+            "repeat": args.repeat
+        },
+        "results": bench.results
+    }
+
+
+def compare(result, baseline, threshold):
+    """Compares the medians with the baseline, returns the names of the
+    benchmarks that regressed."""
+    log = logging.getLogger("compare")
+    if baseline.get("params") != result["params"]:
+        log.warning("Baseline was run with different params: %s",
+                    baseline.get("params"))
+
+    regressions = []
+    comparison = {}
+    for name, stats in sorted(result["results"].items()):
+        base = baseline.get("results", {}).get(name)
+        if base is None:
+            log.info("%-28s no baseline", name)
+            continue
+        ratio = stats["median"] / base["median"] if base["median"] else 0
+        comparison[name] = ratio
+        regressed = ratio > 1 + threshold
+        if regressed:
+            regressions.append(name)
+        log.log(logging.ERROR if regressed else logging.INFO,
+                "%-28s %.6fs vs %.6fs (x%.2f)%s", name, stats["median"],
+                base["median"], ratio, " REGRESSION" if regressed else "")
+    result["comparison"] = comparison
+    return regressions
+
+
+def main():
+    """" The main function."""
+    parser = argparse.ArgumentParser(description="Benchmarks codegen.")
+    parser.add_argument("--fields", type=int, default=20)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--density", type=int, default=4)
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--schemas", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="file to write the results to")
+    parser.add_argument("--baseline", help="results to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logging.getLogger().handlers[0].addFilter(
+        lambda record: record.name in ("Bench", "compare"))
+
+    result = run_benchmarks(args)
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            regressions = compare(result, json.load(file), args.threshold)
+
+    output = json.dumps(result, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+'''
+Differential test of the template backends: every case is compiled by the
+interpreter and by the generated code (see codegen.Template_Code) and the
+outputs, or the errors raised, must be identical.
+
+The cases are the example templates with every example schema, followed by
+random templates and schemas built from token fragments:
+
+    --cases=N       number of random cases
+    --seed=N        seed of the random cases
+    --size=N        maximum number of fragments per random template
+    --timeout=S     seconds after which a case is skipped, as random
+                    templates may expand exponentially
+
+The script exits with 1 when a case differs, logging every difference:
+
+    python3 benchmarks/differential.py --cases=5000 --seed=7
+'''
+
+import argparse
+import glob
+import json
+import logging
+import os
+import random
+import shutil
+import signal
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import codegen  # noqa: E402
+
+FRAGMENTS = ["$$", "!!", "^^", "@@", "@@!", "%%", ".", ".name", ".type",
+             ".fields", ".sub", ".flag", ".n", "..", " ", "  ", "\n", "\n  ",
+             "\n    ", "{{", "}}", " {{", "{{\n", "  }}", "}}\n", "[[0]]",
+             "[[:-1]]", "[[-1]]", "[[1:]]", "[[true]]", "[[1]]", "x", "$",
+             "@", "!", "%", "^", ".include", ".str.upper", ".date.year"]
+VALUES = ["a", "b c", "$$.name", "@@.include", "x$$", "$", "  y", "$$.n$",
+          "@", ".name", "$$.flag@", "!!.n", "$$.", "\n", "\n  z", "{{", "}}"]
+KEYS = ["name", "type", "fields", "sub", "flag", "n"]
+
+
+class Timeout(Exception):
+    """Raised when a case runs out of time."""
+
+
+class Differential(object):
+    """Compiles cases with both backends and collects the differences."""
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.cases = 0
+        self.skipped = 0
+        self.differences = []
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def compare(self, name, schema_path, template):
+        """Compiles the template (a str or codegen.File) with the schema
+        using both backends."""
+        self.cases += 1
+        try:
+            results = [self._compile(schema_path, template, compiled)
+                       for compiled in (False, True)]
+        except Timeout:
+            self.skipped += 1
+            return
+        if results[0] != results[1]:
+            self.differences.append((name, results[0], results[1]))
+            self.log.error("%s differs:\n  interpreted %r\n  compiled    %r",
+                           name, results[0], results[1])
+
+    def _compile(self, schema_path, template, compiled):
+        templates = codegen.Template_Cache()
+        templates.set_compiled(compiled)
+        if self.timeout:
+            signal.setitimer(signal.ITIMER_REAL, self.timeout)
+        try:
+            compiler = codegen.Compiler(codegen.Schema(schema_path),
+                                        templates)
+            return ("output", compiler.compile(template), compiler.tokens())
+        except (Timeout, MemoryError):
+            raise Timeout()
+        except RecursionError:
+            return ("error", "RecursionError")
+        except Exception as ex:  # pylint: disable=broad-except
+            return ("error", type(ex).__name__ + ": " + str(ex))
+        finally:
+            if self.timeout:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def random_text(rng, fragments, count):
+    """Gets a random text joined from the fragments."""
+    return "".join(rng.choice(fragments) for __ in range(count))
+
+
+def random_schema(rng, depth=0):
+    """Gets a random schema json."""
+    def value(depth):
+        r = rng.random()
+        if depth < 3 and r < 0.25:
+            return [value(depth + 1) for __ in range(rng.randint(0, 3))]
+        if depth < 3 and r < 0.4:
+            return {key: value(depth + 1)
+                    for key in rng.sample(KEYS, rng.randint(1, 4))}
+        if r < 0.5:
+            return rng.choice([True, False])
+        if r < 0.6:
+            return rng.randint(0, 3)
+        return random_text(rng, VALUES, rng.randint(0, 3))
+    return {key: value(depth) for key in rng.sample(KEYS, rng.randint(2, 5))}
+
+
+def run_examples(differential):
+    """Compares the example templates with every example schema."""
+    examples = os.path.join(ROOT, "examples")
+    owd = os.getcwd()
+    os.chdir(examples)
+    try:
+        schemas = sorted(glob.glob(os.path.join("schemas", "**", "*.json"),
+                                   recursive=True))
+        templates = sorted(
+            path for path in glob.glob(os.path.join("**", "*"),
+                                       recursive=True)
+            if os.path.isfile(path) and not path.endswith(".json"))
+        for schema in schemas:
+            for template in templates:
+                differential.compare("{} {}".format(schema, template),
+                                     schema, codegen.File(template))
+    finally:
+        os.chdir(owd)
+
+
+def run_random(differential, cases, seed, size):
+    """Compares random templates with random schemas."""
+    rng = random.Random(seed)
+    owd = os.getcwd()
+    directory = tempfile.mkdtemp(prefix="codegen-differential-")
+    os.chdir(directory)
+    try:
+        for case in range(cases):
+            with open("include.template", "w") as file:
+                file.write(random_text(rng, FRAGMENTS, rng.randint(0, 10)))
+            schema = "schema{}.json".format(case % 8)
+            with open(schema, "w") as file:
+                json.dump(random_schema(rng), file)
+            template = random_text(rng, FRAGMENTS, rng.randint(1, size))
+            differential.compare("case {} {!r}".format(case, template),
+                                 schema, template)
+    finally:
+        os.chdir(owd)
+        shutil.rmtree(directory, True)
+
+
+def main():
+    """" The main function."""
+    parser = argparse.ArgumentParser(
+        description="Compares the interpreted and compiled templates.")
+    parser.add_argument("--cases", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--size", type=int, default=40)
+    parser.add_argument("--timeout", type=float, default=2)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logging.getLogger().handlers[0].addFilter(
+        lambda record: record.name == "Differential")
+    sys.setrecursionlimit(400)
+
+    def timeout(*__):
+        raise Timeout()
+
+    if hasattr(signal, "setitimer"):
+        signal.signal(signal.SIGALRM, timeout)
+    else:
+        args.timeout = None
+
+    differential = Differential(args.timeout)
+    run_examples(differential)
+    run_random(differential, args.cases, args.seed, args.size)
+    differential.log.info("%s cases, %s skipped, %s differences",
+                          differential.cases, differential.skipped,
+                          len(differential.differences))
+    sys.exit(1 if differential.differences else 0)
+
+
+if __name__ == '__main__':
+    main()
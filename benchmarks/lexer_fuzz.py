@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+'''
+Differential test of codegen.Token_Lexer: every token of random templates,
+built from token fragments, must be matched exactly as Token.REGEX_TOKEN
+matches it (all groups, their start positions and the end).
+
+Pathological templates, where every token opens a '[[' or '{{' that is
+never closed, are then tokenized by both at the given size and at half of
+it; the lexer must stay linear:
+
+    --cases=N       number of random templates
+    --seed=N        seed of the random templates
+    --size=N        maximum number of fragments per random template
+    --tokens=N      number of tokens of the pathological templates
+    --growth=X      maximum factor of the lexer time when doubling the size
+
+The script exits with 1 when a token differs or the lexer grows faster:
+
+    python3 benchmarks/lexer_fuzz.py --cases=20000 --seed=3
+'''
+
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import codegen  # noqa: E402
+
+FRAGMENTS = ["$$", "!!", "^^", "@@", "@@!", "%%", "$", "@", "!", ".", "..",
+             "...", ".name", ".a", ".b1", ".é", "_", " ", "  ", "\n", "\t",
+             "{{", "}}", " {{", "{{\n", "}}\n", "  }}", "}", "{", "[[", "]]",
+             "[[0]]", "[[1:]]", " [[", "\n[[", "]", "[", "x", "ab"]
+PATHOLOGICAL = ["$$.a{{", "$$.a[[", "$$.a {{\n", "!!.b[[{{"]
+
+
+def regex_matches(content):
+    """Gets the groups of every token matched by Token.REGEX_TOKEN."""
+    matches = []
+    match = codegen.Token.REGEX_TOKEN.search(content)
+    while match is not None:
+        matches.append(groups(match))
+        match = codegen.Token.REGEX_TOKEN.search(content, match.end())
+    return matches
+
+
+def lexer_matches(content):
+    """Gets the groups of every token matched by Token_Lexer."""
+    matches = []
+    lexer = codegen.Token_Lexer(content)
+    match = lexer.match()
+    while match is not None:
+        matches.append(groups(match))
+        match = lexer.match(match.end())
+    return matches
+
+
+def groups(match):
+    """Gets the comparable groups of a match."""
+    return ([match.group(index) for index in range(7)],
+            [match.start(index) for index in range(7)], match.end())
+
+
+def timed(func, content):
+    """Gets the seconds func takes for the content."""
+    start = time.perf_counter()
+    func(content)
+    return time.perf_counter() - start
+
+
+def main():
+    """" The main function."""
+    parser = argparse.ArgumentParser(
+        description="Compares Token_Lexer with Token.REGEX_TOKEN.")
+    parser.add_argument("--cases", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--size", type=int, default=60)
+    parser.add_argument("--tokens", type=int, default=4000)
+    parser.add_argument("--growth", type=float, default=4.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    log = logging.getLogger("Lexer_Fuzz")
+
+    rng = random.Random(args.seed)
+    differences = 0
+    for case in range(args.cases):
+        content = "".join(rng.choice(FRAGMENTS)
+                          for __ in range(rng.randint(0, args.size)))
+        expected = regex_matches(content)
+        actual = lexer_matches(content)
+        if expected != actual:
+            differences += 1
+            log.error("case %s %r:\n  regex %r\n  lexer %r", case, content,
+                      expected, actual)
+    log.info("%s cases, %s differences", args.cases, differences)
+
+    superlinear = 0
+    for fragment in PATHOLOGICAL:
+        half = fragment * (args.tokens // 2)
+        full = fragment * args.tokens
+        growth = timed(lexer_matches, full) / \
+            max(timed(lexer_matches, half), 1e-9)
+        if growth > args.growth:
+            superlinear += 1
+        log.info("%-14r x%s: regex %.4fs, lexer %.4fs (x%.1f for x2 size)",
+                 fragment, args.tokens, timed(regex_matches, full),
+                 timed(lexer_matches, full), growth)
+
+    sys.exit(1 if differences or superlinear else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+'''
+Startup benchmark: the time a new codegen process needs to update a project,
+loading its schemas and templates cold (reading and parsing every file) or
+from a snapshot (see codegen.Snapshot, the --snapshot option).
+
+A synthetic glob project (see bench.py) is generated in a temporary
+directory and updated by new processes, timed per mode:
+
+    noop        every output is up to date, only the schemas are loaded
+    full        the outputs and dependency graph are removed first, every
+                output is compiled
+
+The loading itself is also timed in this process, without compiling. The
+size of the project is configurable:
+
+    --schemas=N     number of schemas in the project
+    --fields=N      fields per schema level
+    --depth=N       nesting depth of the schemas
+    --repeat=N      timed repetitions per benchmark
+
+The results are written as JSON (to stdout or --output=FILE):
+
+    python3 benchmarks/startup.py --schemas=2000
+'''
+
+import argparse
+import glob
+import json
+import logging
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import codegen  # noqa: E402
+from bench import Synthetic  # noqa: E402
+
+
+class Startup(object):
+    """Times the startup of codegen processes on a project."""
+    def __init__(self, directory, repeat):
+        self.directory = directory
+        self.repeat = repeat
+        self.results = {}
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def run(self, name, func, setup=None):
+        """Times func, calling setup (untimed) before every repetition."""
+        times = []
+        for __ in range(self.repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        self.results[name] = {
+            "min": min(times),
+            "median": statistics.median(times),
+            "max": max(times),
+            "repeat": self.repeat
+        }
+        self.log.info("%-24s median %.4fs", name,
+                      self.results[name]["median"])
+
+    def update(self, snapshot):
+        """Updates the project in a new process."""
+        command = [sys.executable, os.path.join(ROOT, "codegen.py"),
+                   "-p=project.json", "--log-level=critical"]
+        if snapshot:
+            command.append("--snapshot")
+        subprocess.run(command, cwd=self.directory, check=True)
+
+    def clean(self):
+        """Removes the outputs and the dependency graph, keeping the
+        snapshot."""
+        shutil.rmtree(os.path.join(self.directory, "build"), True)
+        shutil.rmtree(os.path.join(self.directory, ".codegen-cache", "deps"),
+                      True)
+
+
+def load_cold(directory):
+    """Loads every schema and template of the project from its file."""
+    registry = codegen.Schema_Registry(directory=directory)
+    templates = codegen.Template_Cache()
+    for path in glob.glob(os.path.join(directory, "schemas", "*.json")):
+        registry.get(os.path.relpath(path, directory))
+    for path in glob.glob(os.path.join(directory, "templates", "*.h")):
+        templates.load(codegen.File(path))
+
+
+def load_snapshot(directory, path):
+    """Loads every schema and template of the project from the snapshot,
+    checking the schema files for modifications."""
+    registry = codegen.Schema_Registry(directory=directory)
+    templates = codegen.Template_Cache()
+    schemas, parsed = codegen.Snapshot(path).load()
+    for schema_path, state in schemas.items():
+        registry.restore(schema_path, state)
+    for template in parsed:
+        templates.restore(template)
+    for schema_path in schemas:
+        registry.get(schema_path)
+
+
+def run_benchmarks(args):
+    """Runs all benchmarks, returns the results."""
+    directory = tempfile.mkdtemp(prefix="codegen-startup-")
+    try:
+        synthetic = Synthetic(directory, args.fields, args.depth, 4, 4)
+        synthetic.write(args.schemas)
+        # age the inputs, files modified within the mtime resolution are
+        # left out of the snapshot
+        for root, __, names in os.walk(directory):
+            for name in names:
+                os.utime(os.path.join(root, name), (1, 1))
+        startup = Startup(directory, args.repeat)
+
+        startup.update(False)
+        startup.run("process.noop.cold", lambda: startup.update(False))
+        startup.update(True)
+        startup.run("process.noop.snapshot", lambda: startup.update(True))
+        startup.run("process.full.cold", lambda: startup.update(False),
+                    setup=startup.clean)
+        startup.run("process.full.snapshot", lambda: startup.update(True),
+                    setup=startup.clean)
+
+        snapshots = glob.glob(os.path.join(directory, ".codegen-cache",
+                                           "snapshots", "*.pickle"))
+        startup.run("load.cold", lambda: load_cold(directory))
+        startup.run("load.snapshot",
+                    lambda: load_snapshot(directory, snapshots[0]))
+    finally:
+        shutil.rmtree(directory, True)
+
+    results = startup.results
+    return {
+        "params": {
+            "schemas": args.schemas,
+            "fields": args.fields,
+            "depth": args.depth,
+            "repeat": args.repeat
+        },
+        "results": results,
+        "speedup": {
+            name: results[name + ".cold"]["median"]
+            / results[name + ".snapshot"]["median"]
+            for name in ("process.noop", "process.full", "load")
+        }
+    }
+
+
+def main():
+    """" The main function."""
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the startup of codegen with a snapshot.")
+    parser.add_argument("--schemas", type=int, default=1000)
+    parser.add_argument("--fields", type=int, default=20)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="file to write the results to")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logging.getLogger().handlers[0].addFilter(
+        lambda record: record.name == "Startup")
+
+    output = json.dumps(run_benchmarks(args), indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
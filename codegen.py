@@ -23,44 +23,268 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
 
+import array
+import asyncio
+import collections
+import concurrent.futures
+import cProfile
+import ctypes
+import ctypes.util
 import datetime
+import fnmatch
+import functools
 import glob
+import hashlib
+import itertools
 import json
 import logging
+import mmap
 import os
+import pickle
 import re
+import select
+import signal
+import socket
+import stat
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 
+# A file modified within the mtime resolution of reading it may change again
+# without its mtime changing, such files are checked again.
+RACY_NS = 2 * 10 ** 9
+
 
 class Git_Helper(object):
-    """Helper class to get git config information."""
+    """Helper class to get git config information.
+
+    The config files (system, global and repository) are read in-process.
+    git itself is only run for configs this parser does not handle, such as
+    includes or config set through the environment. Values are kept until
+    invalidate() is called.
+    """
     LOG = logging.getLogger("Git_Helper")
 
+    ENVIRONMENT = ("GIT_DIR", "GIT_COMMON_DIR", "GIT_CONFIG",
+                   "GIT_CONFIG_GLOBAL", "GIT_CONFIG_SYSTEM",
+                   "GIT_CONFIG_NOSYSTEM", "GIT_CONFIG_COUNT",
+                   "GIT_CONFIG_PARAMETERS")
+    ESCAPES = {"n": "\n", "t": "\t", "b": "\b", "\"": "\"", "\\": "\\"}
+    REGEX_SECTION = re.compile(
+        r'\[[ \t]*([\w.-]+)(?:[ \t]+"((?:[^"\\\n]|\\.)*)")?[ \t]*\]')
+    REGEX_KEY = re.compile(r"([A-Za-z][\w-]*)[ \t]*(=?)")
+
+    subprocess_calls = 0
+    _configs = {}
+
     @staticmethod
-    def config(prop):
-        """ Uses git config to check the value of a property."""
+    def config(prop, directory=None):
+        """ Uses git config to check the value of a property, in the
+        repository of the directory (the working directory by default)."""
+        directory = directory or os.getcwd()
+        config = Git_Helper._config(directory)
+        if config is not None:
+            value = config.get(Git_Helper._key(prop), False)
+            if value is False:
+                Git_Helper.LOG.error(
+                    "Failed to retrieve Git config: %s is not set", prop)
+                return None
+            if value is not None:
+                return value
+
         result = None
+        Git_Helper.subprocess_calls += 1
         try:
-            result = subprocess.check_output(["git", "config", "--get", prop])\
+            result = subprocess.check_output(["git", "config", "--get", prop],
+                                             cwd=directory)\
                 .decode("utf-8").replace("\n", "")
         except subprocess.CalledProcessError as ex:
             Git_Helper.LOG.error("Failed to retrieve Git config: %s", str(ex))
         return result
 
+    @staticmethod
+    def invalidate():
+        """Forgets the config read so far."""
+        Git_Helper._configs = {}
+
+    @staticmethod
+    def _key(prop):
+        section, __, name = prop.rpartition(".")
+        section, dot, subsection = section.partition(".")
+        return section.lower() + dot + subsection + "." + name.lower()
+
+    @staticmethod
+    def _config(directory):
+        """Gets the merged config of the directory, None if it cannot be
+        read in-process."""
+        configs = Git_Helper._configs
+        if directory in configs:
+            return configs[directory]
+        # invalidate() may replace the dict meanwhile, so return the local
+        config = Git_Helper._read_config(directory)
+        configs[directory] = config
+        return config
+
+    @staticmethod
+    def _read_config(directory):
+        if any(var in os.environ for var in Git_Helper.ENVIRONMENT):
+            return None
+
+        xdg = os.environ.get("XDG_CONFIG_HOME") \
+            or os.path.join(os.path.expanduser("~"), ".config")
+        paths = ["/etc/gitconfig",
+                 os.path.join(xdg, "git", "config"),
+                 os.path.join(os.path.expanduser("~"), ".gitconfig")]
+        git_dir = Git_Helper._git_dir(directory)
+        if git_dir is not None:
+            paths.append(os.path.join(git_dir, "config"))
+
+        config = {}
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            try:
+                with open(path, "r", encoding="utf-8") as file:
+                    entries = Git_Helper._parse(file.read())
+            except (IOError, UnicodeDecodeError):
+                return None
+            if entries is None:
+                return None
+            config.update(entries)
+
+        if config.get("extensions.worktreeconfig") is not None:
+            return None
+        return config
+
+    @staticmethod
+    def _git_dir(directory):
+        """Finds the directory holding the repository config."""
+        while True:
+            dot_git = os.path.join(directory, ".git")
+            if os.path.isdir(dot_git):
+                return dot_git
+            if os.path.isfile(dot_git):
+                with open(dot_git, "r") as file:
+                    content = file.read().strip()
+                if not content.startswith("gitdir:"):
+                    return None
+                git_dir = os.path.join(directory, content[7:].strip())
+                common = os.path.join(git_dir, "commondir")
+                if os.path.isfile(common):
+                    with open(common, "r") as file:
+                        git_dir = os.path.join(git_dir, file.read().strip())
+                return git_dir
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                return None
+            directory = parent
+
+    @staticmethod
+    def _parse(content):
+        """Parses a git config file into a dict of keys and values, None when
+        it uses features only git itself handles."""
+        entries = {}
+        section = None
+        pos = 0
+        while pos < len(content):
+            char = content[pos]
+            if char in " \t\r\n":
+                pos += 1
+            elif char in "#;":
+                pos = Git_Helper._line_end(content, pos)
+            elif char == "[":
+                match = Git_Helper.REGEX_SECTION.match(content, pos)
+                if not match:
+                    return None
+                section = match.group(1).lower()
+                if section in ("include", "includeif"):
+                    return None
+                if match.group(2) is not None:
+                    section += "." + re.sub(r"\\(.)", r"\1", match.group(2))
+                pos = match.end()
+            else:
+                match = Git_Helper.REGEX_KEY.match(content, pos)
+                if not match or section is None:
+                    return None
+                key = section + "." + match.group(1).lower()
+                if match.group(2):
+                    value, pos = Git_Helper._parse_value(content, match.end())
+                    if value is None:
+                        return None
+                else:
+                    value = None
+                    pos = Git_Helper._line_end(content, match.end())
+                entries[key] = value
+        return entries
+
+    @staticmethod
+    def _parse_value(content, pos):
+        value = []
+        spaces = 0
+        quoted = False
+        while pos < len(content):
+            char = content[pos]
+            pos += 1
+            if char == "\n":
+                if quoted:
+                    return None, pos
+                break
+            if not quoted and char in "#;":
+                pos = Git_Helper._line_end(content, pos)
+                break
+            if not quoted and char in " \t\r":
+                if value:
+                    spaces += 1
+                continue
+            if char == "\\":
+                if pos == len(content):
+                    return None, pos
+                char = content[pos]
+                pos += 1
+                if char == "\n":
+                    continue
+                if char not in Git_Helper.ESCAPES:
+                    return None, pos
+                char = Git_Helper.ESCAPES[char]
+            elif char == "\"":
+                quoted = not quoted
+                char = ""
+            value.append(" " * spaces + char)
+            spaces = 0
+        if quoted:
+            return None, pos
+        return "".join(value), pos
+
+    @staticmethod
+    def _line_end(content, pos):
+        end = content.find("\n", pos)
+        return len(content) if end == -1 else end + 1
+
 
 class FunctionResolver(object):
-    """Contains resolvable functions."""
+    """Contains resolvable functions.
+
+    The date is pinned from begin_run() on, so every output of a run sees
+    the same values. A Compile_Context resolves the date, git and current
+    project functions for its own run, directory and project.
+    """
 
     DATE_FUNCTIONS = {
-        "now": lambda x: datetime.datetime.now().strftime(x)
+        "now": lambda x: FunctionResolver.now().strftime(x)
+    }
+
+    GIT_CONFIGS = {
+        "email": "user.email",
+        "name": "user.name",
+        "remote": "remote.origin.url"
     }
 
     GIT_FUNCTIONS = {
-        "email": lambda: Git_Helper.config("user.email"),
-        "name": lambda: Git_Helper.config("user.name"),
-        "remote": lambda: Git_Helper.config("remote.origin.url")
+        name: functools.partial(Git_Helper.config, prop)
+        for name, prop in GIT_CONFIGS.items()
     }
 
     PROJECT_FUNCTIONS = {
@@ -74,6 +298,9 @@ class FunctionResolver(object):
         "snake": lambda x: x.replace(" ", "_")
     }
 
+    # groups of functions whose value only depends on their argument
+    PURE = ("str",)
+
     FUNCTIONS = {
         "date": DATE_FUNCTIONS,
         "git": GIT_FUNCTIONS,
@@ -81,16 +308,49 @@ class FunctionResolver(object):
         "str": STRING_FUNCTIONS
     }
 
+    _now = None
+    _values = {}
+
     @staticmethod
-    def resolve(path):
-        """Gets the value corresponding with the path, None otherwise."""
+    def begin_run(now=None):
+        """Starts a run, reading the git config and checking included files
+        again. Returns the time the run is pinned to."""
+        FunctionResolver._now = now or datetime.datetime.now()
+        Git_Helper.invalidate()
+        Include_Cache.default().begin_run()
+        return FunctionResolver._now
+
+    @staticmethod
+    def now():
+        """Gets the time of the current run."""
+        return FunctionResolver._now or datetime.datetime.now()
+
+    @staticmethod
+    def call(path, func, directory=None, run=None):
+        """Calls a function without arguments, caching its value for the
+        directory during the run (the time it is pinned to, see begin_run).
+        Runs of projects updated at the same time keep their own values."""
+        key = (directory, tuple(path))
+        entry = FunctionResolver._values.get(key)
+        if entry is not None and entry[0] == run:
+            Stats.default().count("functions.hit")
+            return entry[1]
+        Stats.default().count("functions.miss")
+        value = func()
+        FunctionResolver._values[key] = (run, value)
+        return value
+
+    @staticmethod
+    def resolve(path, functions=None):
+        """Gets the value corresponding with the path in the functions,
+        FUNCTIONS by default, None otherwise."""
         if isinstance(path, str):
             path = path.split(".")
         elif not isinstance(path, list):
             raise ValueError("Expected str or list:", path)
 
         curr_path = []
-        func = FunctionResolver.FUNCTIONS
+        func = functions or FunctionResolver.FUNCTIONS
         for seg in path:
             if callable(func):
                 raise ValueError("Function does not exist ('{}''). "
@@ -123,6 +383,275 @@ class FunctionResolver(object):
         return func
 
 
+class Compile_Context(object):
+    """The state of a compile besides its schema and templates: the
+    directory relative paths are resolved in (the working directory by
+    default), the values of the %%.project.current functions and the time
+    the run is pinned to (see FunctionResolver.begin_run by default).
+
+    Compiles with their own context can run at the same time, also for
+    different projects. Function values are shared by the contexts of a
+    run and directory (see FunctionResolver.call).
+    """
+    def __init__(self, directory=None, current=None, started=None):
+        self.directory = directory
+        self.current = current if current is not None \
+            else FunctionResolver.PROJECT_FUNCTIONS["current"]
+        self.started = started
+        self._functions = None
+
+    def __repr__(self):
+        return "Compile_Context[directory='{}', current='{}', "\
+               "started='{}']".format(self.directory, self.current,
+                                      self.started)
+
+    def now(self):
+        """Gets the time the run is pinned to."""
+        return self.started or FunctionResolver.now()
+
+    def path(self, path):
+        """Gets the path relative to the directory."""
+        return os.path.join(self.directory, path) if self.directory else path
+
+    def functions(self):
+        """Gets the functions (see FunctionResolver.FUNCTIONS) with the date,
+        git and current project functions resolving for this context."""
+        if self._functions is None:
+            functions = dict(FunctionResolver.FUNCTIONS)
+            functions["date"] = dict(
+                functions["date"], now=lambda x: self.now().strftime(x))
+            functions["git"] = {
+                name: functools.partial(Git_Helper.config, prop,
+                                        self.directory)
+                for name, prop in FunctionResolver.GIT_CONFIGS.items()
+            }
+            functions["project"] = dict(functions["project"],
+                                        current=self.current)
+            self._functions = functions
+        return self._functions
+
+    def resolve(self, path):
+        """Gets the function or string of the path (see
+        FunctionResolver.resolve)."""
+        return FunctionResolver.resolve(path, self.functions())
+
+    def call(self, path, func):
+        """Calls a function without arguments, caching its value for the
+        run and directory."""
+        return FunctionResolver.call(path, func, self.directory,
+                                     self.started or FunctionResolver._now)
+
+
+class Phase_Timer(object):
+    """Times a phase for Stats, excluding the time spent in nested phases."""
+    def __init__(self, stats=None, phase=None):
+        self._stats = stats
+        self._phase = phase
+        self._start = 0
+
+    def __enter__(self):
+        if self._stats is not None:
+            self._stats.nested().append(0.0)
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if self._stats is not None:
+            elapsed = time.perf_counter() - self._start
+            nested = self._stats.nested()
+            self._stats.add(self._phase, elapsed - nested.pop())
+            if nested:
+                nested[-1] += elapsed
+        return False
+
+
+class Stats(object):
+    """Collects the time spent per phase, totals per template and schema and
+    counters such as cache hits and misses.
+
+    Phase times are exclusive, time spent in a nested phase (reading an
+    include while resolving) only counts for the nested phase, per thread.
+    Nothing is collected until enable() is called.
+    """
+    PHASES = ("glob", "stat", "read", "json", "tokenize", "resolve",
+              "function", "indent", "write")
+    NULL_TIMER = Phase_Timer()
+    _DEFAULT = None
+
+    def __init__(self):
+        self.enabled = False
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __repr__(self):
+        return "Stats[enabled='{}', templates='{}', schemas='{}']".format(
+            self.enabled, len(self._templates), len(self._schemas))
+
+    @staticmethod
+    def default():
+        """Returns the process wide stats."""
+        return Stats._DEFAULT
+
+    @staticmethod
+    def timed(phase):
+        """Decorates a function so that its calls are timed as phase."""
+        def decorate(func):
+            @functools.wraps(func)
+            def timed_func(*args, **kwargs):
+                if not Stats._DEFAULT.enabled:
+                    return func(*args, **kwargs)
+                with Phase_Timer(Stats._DEFAULT, phase):
+                    return func(*args, **kwargs)
+            return timed_func
+        return decorate
+
+    def enable(self, enabled=True):
+        """Starts (or stops) collecting."""
+        self.enabled = enabled
+
+    def reset(self):
+        """Forgets everything collected so far."""
+        self._phases = {phase: [0.0, 0] for phase in Stats.PHASES}
+        self._templates = {}
+        self._schemas = {}
+        self._counters = {}
+        self._gauges = {}
+
+    def timer(self, phase):
+        """Gets a context manager timing the phase."""
+        if not self.enabled:
+            return Stats.NULL_TIMER
+        return Phase_Timer(self, phase)
+
+    def nested(self):
+        """Gets the times of the nested phases of this thread, see
+        Phase_Timer."""
+        nested = getattr(self._local, "nested", None)
+        if nested is None:
+            nested = self._local.nested = []
+        return nested
+
+    def add(self, phase, seconds, calls=1):
+        """Adds time spent in a phase."""
+        with self._lock:
+            totals = self._phases.setdefault(phase, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += calls
+
+    def count(self, counter, amount=1):
+        """Increments a counter, e.g. 'templates.hit'."""
+        if self.enabled:
+            with self._lock:
+                self._counters[counter] = \
+                    self._counters.get(counter, 0) + amount
+
+    def gauge(self, gauge, value):
+        """Sets a gauge to its current value, e.g. 'memory.templates'."""
+        if self.enabled:
+            self._gauges[gauge] = value
+
+    def compiled(self, schema, template, seconds, tokens):
+        """Adds a compile of a template with a schema to their totals."""
+        if not self.enabled:
+            return
+        with self._lock:
+            for totals, path in ((self._templates, template),
+                                 (self._schemas, schema)):
+                total = totals.setdefault(path, [0.0, 0, 0])
+                total[0] += seconds
+                total[1] += 1
+                total[2] += tokens
+
+    def snapshot(self):
+        """Gets the collected stats, to be merged in another process."""
+        return {
+            "phases": self._phases,
+            "templates": self._templates,
+            "schemas": self._schemas,
+            "counters": self._counters
+        }
+
+    def merge(self, snapshot):
+        """Adds a snapshot of another process to the collected stats."""
+        for phase, (seconds, calls) in snapshot["phases"].items():
+            self.add(phase, seconds, calls)
+        with self._lock:
+            for key in ("templates", "schemas"):
+                totals = getattr(self, "_" + key)
+                for path, (seconds, compiles, tokens) in \
+                        snapshot[key].items():
+                    total = totals.setdefault(path, [0.0, 0, 0])
+                    total[0] += seconds
+                    total[1] += compiles
+                    total[2] += tokens
+            for counter, amount in snapshot["counters"].items():
+                self._counters[counter] = \
+                    self._counters.get(counter, 0) + amount
+
+    def caches(self):
+        """Gets the hit rate of every counter group with a miss counter."""
+        groups = {}
+        for counter, amount in self._counters.items():
+            group, __, kind = counter.rpartition(".")
+            groups.setdefault(group, {})[kind] = amount
+        rates = {}
+        for group, kinds in sorted(groups.items()):
+            if "miss" in kinds:
+                total = sum(amount for kind, amount in kinds.items()
+                            if kind != "evicted")
+                rates[group] = (total - kinds["miss"]) / total if total else 0
+        return rates
+
+    def json(self):
+        """Gets the collected stats as json."""
+        def totals(items):
+            return {path: {"seconds": seconds, "compiles": compiles,
+                           "tokens": tokens}
+                    for path, (seconds, compiles, tokens) in items.items()}
+        return json.dumps({
+            "phases": {phase: {"seconds": seconds, "calls": calls}
+                       for phase, (seconds, calls) in self._phases.items()},
+            "templates": totals(self._templates),
+            "schemas": totals(self._schemas),
+            "counters": self._counters,
+            "gauges": self._gauges,
+            "caches": self.caches()
+        }, indent=4, sort_keys=True)
+
+    def table(self, top=10):
+        """Gets the collected stats as a summary table, listing the top
+        slowest templates and schemas."""
+        lines = ["{:<40} {:>12} {:>10}".format("phase", "seconds", "calls")]
+        for phase, (seconds, calls) in self._phases.items():
+            lines.append("{:<40} {:>12.6f} {:>10}".format(
+                phase, seconds, calls))
+        for title, totals in (("template", self._templates),
+                              ("schema", self._schemas)):
+            lines.append("")
+            lines.append("{:<40} {:>12} {:>10} {:>10}".format(
+                title, "seconds", "compiles", "tokens"))
+            slowest = sorted(totals.items(), key=lambda item: -item[1][0])
+            for path, (seconds, compiles, tokens) in slowest[:top]:
+                lines.append("{:<40} {:>12.6f} {:>10} {:>10}".format(
+                    path[-40:], seconds, compiles, tokens))
+            if len(slowest) > top:
+                lines.append("... {} more".format(len(slowest) - top))
+        lines.append("")
+        lines.append("{:<40} {:>12}".format("counter", "value"))
+        for counter, amount in sorted(self._counters.items()):
+            lines.append("{:<40} {:>12}".format(counter, amount))
+        for group, rate in self.caches().items():
+            lines.append("{:<40} {:>11.1f}%".format(group + " hit rate",
+                                                    rate * 100))
+        for gauge, value in sorted(self._gauges.items()):
+            lines.append("{:<40} {:>12}".format(gauge, value))
+        return "\n".join(lines)
+
+
+Stats._DEFAULT = Stats()
+
+
 class Token(object):
     """Contains functionality to read and store codegen tokens."""
     R_OPERATOR = r"(\$\$|!!|\^\^|@@!|@@|%%)(?=\.)"
@@ -132,6 +661,9 @@ class Token(object):
 
     REGEX_TOKEN = re.compile(
         R_OPERATOR + R_PATH + R_SELECT + R_EXPANSION, re.DOTALL | re.MULTILINE)
+    REGEX_OPERATOR = re.compile(R_OPERATOR)
+    REGEX_TRAILING = re.compile(r"\s*")
+    REGEX_INDENTED = re.compile(r"[^ \t\n]")
 
     def __init__(self, match):
         self.operator = match.group(1)
@@ -143,6 +675,10 @@ class Token(object):
         self.indent = self._expansion_indent()
         self.start = match.start()
         self.end = match.end()
+        self._match_end = self.end
+        self._expansion_start = match.start(4)
+        self.contained = True
+        self.body = None
 
         if self.expansion is not None and self.expansion.count("\n") == 0:
             if self.eol:
@@ -156,12 +692,16 @@ class Token(object):
                                                self.select, self.expansion,
                                                self.start, self.end)
 
-    def resolve_template(self, cut_last_char=False):
-        """Resolves the template from the token path."""
-        template = File(os.path.join(*self.path) + ".template").read()
-        if cut_last_char:
-            template = template[:-1]
-        return template
+    def template_path(self):
+        """Gets the path of the template referenced by an include token."""
+        return os.path.join(*self.path) + ".template"
+
+    def resolve_template(self, cut_last_char=False, directory=None):
+        """Resolves the template from the token path, relative to the
+        directory (the working directory by default), returns its contents
+        and signature (see Include_Cache.read_signed)."""
+        return Include_Cache.default().read_signed(self.template_path(),
+                                                   cut_last_char, directory)
 
     def resolve_indices(self, lst):
         """Resolves the list indices from the token select."""
@@ -182,32 +722,182 @@ class Token(object):
         return indices
 
     def _expansion_indent(self):
+        """Gets the indent of the first visible character of the expansion,
+        counted from (and including) the newline before it, 0 if there is
+        no visible character."""
         if self.expansion:
-            indent = 0
-            for c in self.expansion:
-                if c == '\n':
-                    indent = 0
-                elif c != ' ' and c != '\t':
-                    return indent
-                indent += 1
-            return 0
-
-    @staticmethod
-    def find(content):
-        """Finds the first token in the given string."""
-        match = Token.REGEX_TOKEN.search(content)
+            match = Token.REGEX_INDENTED.search(self.expansion)
+            if match is None:
+                return 0
+            newline = self.expansion.rfind("\n", 0, match.start())
+            return match.start() - newline if newline != -1 \
+                else match.start()
+
+    def is_contained(self, content):
+        """Checks whether the token would match the same way if more text
+        were appended to the content it was found in."""
+        start = self._expansion_start
+        if start >= 2 and content[start - 2:start] == "{{" \
+                and content.startswith("\n", start):
+            # '{{\n}}' only matches with the newline as the expansion, with
+            # a '}}' further on it would become part of a longer expansion
+            return False
+        match = Token.REGEX_TRAILING.match(content, self._match_end)
+        return match.end() < len(content) \
+            and content[match.end()] not in "[{"
+
+    @staticmethod
+    def find(content, pos=0):
+        """Finds the first token in the given string, starting at pos. Use a
+        Token_Lexer to find all tokens of a string."""
+        return Token_Lexer(content).find(pos)
+
+    @staticmethod
+    def starts_at_boundary(head, tail):
+        """Checks whether an operator starts in the last characters of head
+        and only becomes a token once tail is appended."""
+        head = head[-3:]
+        match = Token.REGEX_OPERATOR.search(head + tail[:4])
+        return match is not None and match.start() < len(head)
+
+
+class Token_Match(object):
+    """The groups and their start positions of a token found by Token_Lexer,
+    with the interface of a match of Token.REGEX_TOKEN."""
+    def __init__(self, groups, starts, end):
+        self._groups = groups
+        self._starts = starts
+        self._end = end
+
+    def __repr__(self):
+        return "Token_Match[span='{}', groups='{}']".format(
+            (self._starts[0], self._end), self._groups)
+
+    def group(self, index=0):
+        """Gets the text of a group, None if it did not participate."""
+        return self._groups[index]
+
+    def start(self, index=0):
+        """Gets the start of a group, -1 if it did not participate."""
+        return self._starts[index]
+
+    def end(self):
+        """Gets the end of the match."""
+        return self._end
+
+
+class Token_Lexer(object):
+    """Finds the tokens of a content in linear time.
+
+    Tokens are matched exactly as Token.REGEX_TOKEN matches them: the select
+    ends at the first ']]' and the expansion at the first '}}' after it, so
+    an expansion never contains a '}}' and nested expansions are resolved by
+    compiling the resolved text again. The regex rescans the rest of the
+    content for every '[[' or '{{' that is never closed, quadratic in the
+    worst case. The lexer searches each closing marker once per region of
+    the content and reuses the result for all tokens in that region.
+    """
+    REGEX_PATH = re.compile(r"((?:\.[\w]+)+)?\.{0,2}")
+    REGEX_SELECT = re.compile(r"\s*\[\[")
+
+    def __init__(self, content):
+        self.content = content
+        self._closing = {}
+
+    def __repr__(self):
+        return "Token_Lexer[length='{}']".format(len(self.content))
+
+    def find(self, pos=0):
+        """Finds the first token starting at or after pos."""
+        match = self.match(pos)
         return Token(match) if match else None
 
+    def match(self, pos=0):
+        """Matches the first token starting at or after pos, as
+        Token.REGEX_TOKEN.search(content, pos) would."""
+        content = self.content
+        operator = Token.REGEX_OPERATOR.search(content, pos)
+        if operator is None:
+            return None
+        start = operator.start()
+        path = Token_Lexer.REGEX_PATH.match(content, operator.end())
+        end = path.end()
+        groups = [None, operator.group(1), path.group(1), None, None, None,
+                  None]
+        starts = [start, start, path.start(1), -1, -1, -1, -1]
+
+        select = Token_Lexer.REGEX_SELECT.match(content, end)
+        if select is not None:
+            close = self._close("]]", select.end())
+            if close != -1:
+                groups[3] = content[select.end():close]
+                starts[3] = select.end()
+                end = close + 2
+
+        if content.startswith(" {{", end):
+            begin = end + 3
+        elif content.startswith("{{", end):
+            begin = end + 2
+        else:
+            begin = -1
+        if begin != -1:
+            close = -1
+            if content.startswith("\n", begin):
+                close = self._close("}}", begin + 2)
+                if close != -1:
+                    begin += 1
+                elif content.startswith("}}", begin + 1):
+                    close = begin + 1
+            else:
+                close = self._close("}}", begin + 1)
+            if close != -1:
+                spaces = close
+                while spaces > begin + 1 and content[spaces - 1] == " ":
+                    spaces -= 1
+                groups[4] = content[begin:spaces]
+                groups[5] = content[spaces:close]
+                starts[4] = begin
+                starts[5] = spaces
+                end = close + 2
+                if content.startswith("\n", end):
+                    groups[6] = "\n"
+                    starts[6] = end
+                    end += 1
+
+        groups[0] = content[start:end]
+        return Token_Match(groups, starts, end)
+
+    def _close(self, marker, pos):
+        """Gets the position of the first marker at or after pos, -1 if there
+        is none. A search is reused for every pos up to the marker found."""
+        searched = self._closing.get(marker)
+        if searched is not None and searched[0] <= pos \
+                and (searched[1] == -1 or pos <= searched[1]):
+            return searched[1]
+        found = self.content.find(marker, pos)
+        self._closing[marker] = (pos, found)
+        return found
 
-class File(object):
-    """Helper class for file operations."""
 
-    def __init__(self, path):
+class File(object):
+    """Helper class for file operations.
+
+    A relative path is relative to the directory, the working directory by
+    default, so files of several projects can be used at the same time.
+    """
+    # Read once, os.umask() can only be read by setting it.
+    UMASK = os.umask(0o022)
+    os.umask(UMASK)
+    # Basenames of the temporary files written before replacing a file.
+    REGEX_TEMP = re.compile(r"\..*\.tmp\Z")
+
+    def __init__(self, path, directory=None):
         if not isinstance(path, str):
             raise ValueError(
                 "File() - Expected string: ", path)
 
         self._path = path
+        self._file = os.path.join(directory, path) if directory else path
         self._atime = None
         self._mtime = None
         self._contents = None
@@ -217,6 +907,7 @@ class File(object):
         return "File[path='{}', atime='{}', mtime='{}']".format(
             self._path, self._atime, self._mtime)
 
+    @Stats.timed("stat")
     def atime(self, no_cache=True):
         """Get the last access time."""
         if no_cache or self._atime is None:
@@ -226,13 +917,14 @@ class File(object):
                                   "%s", self._path)
             else:
                 try:
-                    self._atime = os.path.getatime(self._path)
+                    self._atime = os.path.getatime(self._file)
                 except OSError as ex:
                     self._logger.error("File.atime - OS exception: %s %s",
                                        self._path, ex)
 
         return self._atime
 
+    @Stats.timed("stat")
     def mtime(self, no_cache=True):
         """Get the last modified time."""
         if no_cache or self._mtime is None:
@@ -242,29 +934,51 @@ class File(object):
                                   "%s", self._path)
             else:
                 try:
-                    self._mtime = os.path.getmtime(self._path)
+                    self._mtime = os.path.getmtime(self._file)
                 except OSError as ex:
                     self._log.error("File.mtime - OS exception: %s %s",
                                     self._path, ex)
 
         return self._mtime
 
+    @Stats.timed("stat")
     def exists(self):
         """Checks whether file exists."""
-        return os.path.isfile(self._path)
+        return os.path.isfile(self._file)
 
     def path(self):
         """Gets the file path."""
         return self._path
 
+    @Stats.timed("stat")
+    def signature(self):
+        """Gets the (mtime, size) of the file, None if it cannot be read."""
+        try:
+            stat = os.stat(self._file)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+
+    @staticmethod
+    def is_racy(signature):
+        """Checks whether a file with the signature was modified within
+        RACY_NS, it may change again without its signature changing."""
+        return time.time() - signature[0] <= RACY_NS / 10 ** 9
+
     def basename(self):
         """Returns the file basename."""
         return os.path.basename(self._path)
 
+    @staticmethod
+    def is_temp(path):
+        """Checks whether the path is a temporary file, see write_temp()."""
+        return File.REGEX_TEMP.match(os.path.basename(path)) is not None
+
     def parent_dir(self):
         """Gets the parent directoy of the file."""
         return os.path.dirname(self._path)
 
+    @Stats.timed("read")
     def read(self, no_cache=True):
         """Reads the contents of the file."""
         if no_cache and self._mtime != self.mtime() or self._contents is None:
@@ -274,7 +988,7 @@ class File(object):
                                   "%s", self._path)
             else:
                 try:
-                    with open(self._path, 'r') as file:
+                    with open(self._file, 'r') as file:
                         self._contents = file.read()
                 except FileNotFoundError as ex:
                     self._log.error("File.read - File not found: %s %s",
@@ -290,18 +1004,21 @@ class File(object):
         if not self.exists():
             self.write("")
         else:
-            os.utime(self._path)
+            os.utime(self._file)
             self.atime()
             self.mtime()
 
     def write(self, contents):
-        """Writes the contents to cache and disk."""
+        """Writes the contents to cache and disk.
+
+        The contents are written to a temporary file that then replaces the
+        file, so an interrupted write never leaves a truncated file behind.
+        """
         success = False
         try:
-            os.makedirs(os.path.dirname(self._path), exist_ok=True)
-            with open(self._path, 'w') as file:
-                file.write(contents)
-                success = True
+            tmp_path, __ = self.write_temp([contents])
+            self.replace(tmp_path)
+            success = True
         except IOError as ex:
             self._log.error("File.write - An IO error occurred: %s %s",
                             self._path, ex)
@@ -311,6 +1028,68 @@ class File(object):
 
         return success
 
+    @Stats.timed("write")
+    def write_temp(self, chunks):
+        """Writes the chunks to a temporary file next to the file, see
+        replace(). Returns the path of the temporary file and the sha1 hex
+        digest of the contents."""
+        directory = os.path.dirname(self._file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(
+            prefix="." + self.basename() + ".", suffix=".tmp",
+            dir=directory or os.curdir)
+        digest = hashlib.sha1()
+        try:
+            with os.fdopen(fd, 'w') as file:
+                for chunk in chunks:
+                    file.write(chunk)
+                    digest.update(chunk.encode("utf-8"))
+        except BaseException:
+            File.discard(tmp_path)
+            raise
+        return tmp_path, digest.hexdigest()
+
+    @Stats.timed("write")
+    def replace(self, tmp_path):
+        """Replaces the file with a temporary file written by write_temp."""
+        try:
+            os.chmod(tmp_path, self._mode())
+            os.replace(tmp_path, self._file)
+            Include_Cache.default().invalidate(self._file)
+        except BaseException:
+            File.discard(tmp_path)
+            raise
+
+    @staticmethod
+    def discard(tmp_path):
+        """Removes a temporary file written by write_temp."""
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+    @Stats.timed("read")
+    def digest(self):
+        """Gets the sha1 hex digest of the contents of the file, None if it
+        cannot be read."""
+        digest = hashlib.sha1()
+        try:
+            with open(self._file, 'r') as file:
+                for chunk in iter(lambda: file.read(1 << 16), ""):
+                    digest.update(chunk.encode("utf-8"))
+        except (IOError, UnicodeDecodeError):
+            return None
+        return digest.hexdigest()
+
+    def _mode(self):
+        """Gets the permissions for a (re)written file: those of the existing
+        file, or the default permissions for new files."""
+        try:
+            return os.stat(self._file).st_mode & 0o7777
+        except OSError:
+            return 0o666 & ~File.UMASK
+
     def empty_cache(self):
         """Empties the cache."""
         self._atime = None
@@ -320,14 +1099,16 @@ class File(object):
 
 class Schema(File):
     """Contains functionality to parse and view a json schema."""
-    def __init__(self, path, initialise_json=True):
+    def __init__(self, path, initialise_json=True, directory=None):
         if not isinstance(path, str):
             raise ValueError("Schema() - Expected str: ", path)
 
-        File.__init__(self, path)
+        File.__init__(self, path, directory)
         self.log = logging.getLogger(self.__class__.__name__)
         self._mtime = None
         self._json = None
+        self._signature = None
+        self._index = {}
 
     def __repr__(self):
         return "Schema[file={}]".format(self.path())
@@ -337,13 +1118,43 @@ class Schema(File):
         return self.path()
 
     def update(self):
-        """Updates the schema if it has been modified."""
+        """Updates the schema if it has been modified, returns True if the
+        schema was (re)loaded."""
+        signature = self.signature()
+        if signature is not None and signature == self._signature:
+            return False
+
+        self.empty_cache()
+        self._index = {}
         contents = self.read()
         if contents:
-            self._json = json.loads(contents)
+            with Stats.default().timer("json"):
+                self._json = json.loads(contents)
+            # a racy schema is loaded again by the next update
+            self._signature = signature \
+                if signature is not None and not File.is_racy(signature) \
+                else None
+            # the parsed json is all that is used, don't keep the text too
+            self._contents = None
         else:
             self.log.error("Could not load json from file: %s", self.path())
             self._json = {}
+            self._signature = None
+        return True
+
+    def state(self):
+        """Gets the (signature, json) the schema was loaded with, to be
+        restored in another process (see Snapshot), None if not loaded."""
+        if self._signature is None:
+            return None
+        return self._signature, self._json
+
+    def restore(self, state):
+        """Restores the state of a schema loaded by another process. It is
+        only loaded again by update() when its signature changed."""
+        self.empty_cache()
+        self._index = {}
+        self._signature, self._json = state
 
     def json(self, path=None):
         """Returns the json contained in the schema."""
@@ -362,7 +1173,7 @@ class Schema(File):
         if scope is None:
             scope = []
 
-        scope += path
+        scope = scope + path
         var = self._json
         for seg in scope:
             if isinstance(var, list):
@@ -378,46 +1189,1244 @@ class Schema(File):
 
         return var
 
+    def node(self, scope):
+        """Looks up the value of an absolute scope without logging. Returns
+        a (found, value) tuple, found lookups are memoized until the schema
+        is reloaded."""
+        key = tuple(scope)
+        if key in self._index:
+            Stats.default().count("nodes.hit")
+            return True, self._index[key]
+        Stats.default().count("nodes.miss")
+        found, var = self.walk(scope, self._json, 0)
+        if found:
+            self._index[key] = var
+        return found, var
+
+    @staticmethod
+    def walk(scope, var, start):
+        """Walks the segments of the scope from start on without logging,
+        var being the value of the scope up to start. Returns a (found,
+        value) tuple; value() reports why a lookup was not found."""
+        try:
+            for i in range(start, len(scope)):
+                seg = scope[i]
+                if isinstance(var, list):
+                    if not isinstance(seg, int) or seg >= len(var):
+                        return False, None
+                elif seg not in var:
+                    return False, None
+                var = var[seg]
+        except (TypeError, IndexError):
+            return False, None
+
+        return True, var
+
+
+class Json_Index(object):
+    """Indexes a json document held in a buffer, such as an mmap, on demand.
+
+    A value is identified by its (start, end) span in the buffer. The members
+    of a container are only scanned when the container is accessed (see
+    Lazy_List and Lazy_Dict), and a value is only parsed when it is reached.
+    The document is expected to be utf-8, as written by json.dump.
+    """
+    REGEX_SPACE = re.compile(rb"[ \t\n\r]*")
+    REGEX_STRING = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+    REGEX_SCALAR = re.compile(rb"[^ \t\n\r,:\]}]*")
+    REGEX_SKIP = re.compile(
+        rb'(?:[^"\[\]{}]+|"[^"\\]*(?:\\.[^"\\]*)*")*', re.DOTALL)
+    DECODER = json.JSONDecoder()
+    WINDOWS = (4096, 65536)
+    CHUNK = 1 << 18
+    NON_BRACKETS = bytes(c for c in range(256) if c not in b"[]{}")
+    DEPTHS = bytes.maketrans(b"[{]}", b"\x01\x01\xff\xff")
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+        self._members = {}
+
+    def __repr__(self):
+        return "Json_Index[size='{}', containers='{}']".format(
+            len(self._buffer), len(self._members))
+
+    def root(self):
+        """Gets the value of the document."""
+        start = self._skip(0)
+        end = len(self._buffer)
+        while end > start and self._buffer[end - 1:end] in b" \t\n\r":
+            end -= 1
+        return self.value((start, end))
+
+    def value(self, span):
+        """Gets the value at the span, a Lazy_List or Lazy_Dict for a
+        container."""
+        opening = self._buffer[span[0]:span[0] + 1]
+        if opening == b"[":
+            return Lazy_List(self, span)
+        if opening == b"{":
+            return Lazy_Dict(self, span)
+        return self.load(span)
+
+    def load(self, span):
+        """Parses the value at the span."""
+        return json.loads(self._buffer[span[0]:span[1]])
+
+    def members(self, span):
+        """Gets the members of the container at the span: a list of spans for
+        an array and a dict of spans by key for an object."""
+        if span in self._members:
+            return self._members[span]
+
+        start = span[0]
+        if self._buffer[start:start + 1] == b"[":
+            members, closing = [], b"]"
+        else:
+            members, closing = {}, b"}"
+
+        pos = self._skip(start + 1)
+        if self._buffer[pos:pos + 1] != closing:
+            while True:
+                if closing == b"}":
+                    end = self._string_end(pos)
+                    key = json.loads(self._buffer[pos:end])
+                    pos = self._expect(self._skip(end), b":")
+                    end = self._end(pos)
+                    members[key] = (pos, end)
+                else:
+                    end = self._end(pos)
+                    members.append((pos, end))
+                pos = self._skip(end)
+                if self._buffer[pos:pos + 1] != b",":
+                    break
+                pos = self._skip(pos + 1)
+            self._expect(pos, closing)
+
+        self._members[span] = members
+        return members
+
+    def _skip(self, pos):
+        return self.REGEX_SPACE.match(self._buffer, pos).end()
+
+    def _expect(self, pos, char):
+        if self._buffer[pos:pos + 1] != char:
+            raise ValueError("Invalid json at {}: expected {}".format(
+                pos, char.decode()))
+        return self._skip(pos + 1)
+
+    def _end(self, pos):
+        char = self._buffer[pos:pos + 1]
+        if char == b'"':
+            return self._string_end(pos)
+        if char == b"[" or char == b"{":
+            return self._container_end(pos)
+        end = self.REGEX_SCALAR.match(self._buffer, pos).end()
+        if end == pos:
+            raise ValueError("Invalid json at {}: expected a value".format(
+                pos))
+        return end
+
+    def _string_end(self, pos):
+        match = self.REGEX_STRING.match(self._buffer, pos)
+        if match is None:
+            raise ValueError("Invalid json at {}: expected a string".format(
+                pos))
+        return match.end()
+
+    def _container_end(self, pos):
+        # a small container is decoded as a whole by the C decoder, which is
+        # faster than scanning it, a large one is skipped without parsing
+        for size in self.WINDOWS:
+            window = self._buffer[pos:pos + size]
+            if not window.isascii():
+                break
+            try:
+                return pos + self.DECODER.raw_decode(window.decode())[1]
+            except ValueError:
+                if len(window) < size:
+                    break
+        return self._skip_container(pos)
+
+    def _skip_container(self, pos):
+        # whole chunks are skipped by counting the brackets outside of their
+        # strings, the chunk the container closes in is scanned bracket by
+        # bracket; chunks are cut so that they never end inside a string
+        start = pos
+        depth = 1
+        pos += 1
+        while pos < len(self._buffer):
+            end = pos + self.CHUNK
+            while True:
+                chunk = self._buffer[pos:end]
+                if b"\\" in chunk:
+                    # blanking the escapes keeps the positions of the quotes
+                    chunk = chunk.replace(b"\\\\", b"__")
+                    chunk = chunk.replace(b'\\"', b"__")
+                parts = chunk.split(b'"')
+                if len(parts) % 2 == 1:
+                    break
+                end = self._string_end(pos + chunk.rindex(b'"'))
+
+            brackets = b"".join(parts[::2]).translate(None, self.NON_BRACKETS)
+            depths = list(itertools.accumulate(
+                array.array("b", brackets.translate(self.DEPTHS)),
+                initial=depth))
+            if min(depths) <= 0:
+                return self._scan_container(pos, depth)
+            depth = depths[-1]
+            pos = end
+
+        raise ValueError("Invalid json at {}: unterminated container".format(
+            start))
+
+    def _scan_container(self, pos, depth):
+        while True:
+            pos = self.REGEX_SKIP.match(self._buffer, pos).end()
+            char = self._buffer[pos:pos + 1]
+            if char == b"[" or char == b"{":
+                depth += 1
+            elif char == b"]" or char == b"}":
+                depth -= 1
+                if depth == 0:
+                    return pos + 1
+            else:
+                raise ValueError("Invalid json at {}: unterminated "
+                                 "container".format(pos))
+            pos += 1
+
+
+class Lazy_List(list):
+    """A json array in a Json_Index that parses its elements when they are
+    accessed. It behaves as the parsed list for lookups, len(), iteration,
+    comparison and repr(); the list itself stays empty."""
+    def __init__(self, document, span):
+        list.__init__(self)
+        self._document = document
+        self._span = span
+        self._values = {}
+
+    def __repr__(self):
+        return repr(self._document.load(self._span))
+
+    def __eq__(self, other):
+        return self._document.load(self._span) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __len__(self):
+        return len(self._document.members(self._span))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(len(self))[index]]
+        span = self._document.members(self._span)[index]
+        if span not in self._values:
+            self._values[span] = self._document.value(span)
+        return self._values[span]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __contains__(self, item):
+        return any(value == item for value in self)
+
+
+class Lazy_Dict(dict):
+    """A json object in a Json_Index that parses its values when they are
+    accessed. It behaves as the parsed dict for lookups, len(), iteration,
+    comparison and repr(); the dict itself stays empty."""
+    def __init__(self, document, span):
+        dict.__init__(self)
+        self._document = document
+        self._span = span
+        self._values = {}
+
+    def __repr__(self):
+        return repr(self._document.load(self._span))
+
+    def __eq__(self, other):
+        return self._document.load(self._span) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __len__(self):
+        return len(self._document.members(self._span))
+
+    def __contains__(self, key):
+        return key in self._document.members(self._span)
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            span = self._document.members(self._span)[key]
+            self._values[key] = self._document.value(span)
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._document.members(self._span))
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return self._document.members(self._span).keys()
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+
+class Lazy_Schema(Schema):
+    """A schema backed by a memory-mapped file, for very large schemas.
+
+    The file is neither read into a string nor parsed up front. Its json is
+    a Lazy_List or Lazy_Dict on a Json_Index, so only the containers on the
+    paths that are looked up are scanned and only the values reached are
+    parsed. Invalid json is therefore only reported once it is reached. The
+    file must be replaced rather than rewritten in place while it is mapped.
+    """
+    def __init__(self, path, directory=None):
+        Schema.__init__(self, path, directory=directory)
+        self._map = None
+
+    def __repr__(self):
+        return "Lazy_Schema[file={}]".format(self.path())
+
+    def update(self):
+        """Maps the schema if it has been modified, returns True if the
+        schema was (re)mapped."""
+        signature = self.signature()
+        if signature is not None and signature == self._signature:
+            return False
+
+        self.empty_cache()
+        self.close()
+        self._index = {}
+        try:
+            with Stats.default().timer("read"):
+                with open(self._file, 'rb') as file:
+                    self._map = mmap.mmap(file.fileno(), 0,
+                                          access=mmap.ACCESS_READ)
+            with Stats.default().timer("json"):
+                self._json = Json_Index(self._map).root()
+            self._signature = signature \
+                if signature is not None and not File.is_racy(signature) \
+                else None
+        except (IOError, ValueError) as ex:
+            self.log.error("Could not load json from file: %s %s",
+                           self.path(), ex)
+            self.close()
+            self._json = {}
+            self._signature = None
+        return True
+
+    def state(self):
+        """Mapped schemas are not restored in other processes."""
+        return None
+
+    def close(self):
+        """Unmaps the file."""
+        self._json = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+class Schema_Registry(object):
+    """Shares parsed schemas between compilers and output items.
+
+    A schema is checked for modifications at most once per run (see
+    begin_run) and only re-parsed when its mtime or size changed. Schemas of
+    at least lazy_size bytes are loaded as a Lazy_Schema. Beyond max_size
+    bytes of schema files the least recently used schemas are evicted.
+    Paths are relative to the directory, the working directory by default.
+    The registry can be shared by threads.
+    """
+    def __init__(self, lazy_size=None, max_size=None, directory=None):
+        self.lazy_size = lazy_size
+        self.directory = directory
+        self._schemas = Lru_Store("schemas", max_size, self._evicted)
+        self._checked = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "Schema_Registry[directory='{}', schemas='{}', hits='{}', "\
+               "misses='{}']".format(self.directory, len(self._schemas),
+                                     self.hits, self.misses)
+
+    def begin_run(self):
+        """Starts a new run, schemas are checked for modifications again."""
+        self._checked = set()
+
+    def get(self, path):
+        """Gets the shared schema for the path, loading it if required."""
+        with self._lock:
+            schema = self._schemas.get(path)
+            if schema is None:
+                schema = self._create(path)
+                try:
+                    size = os.path.getsize(self._file(path))
+                except OSError:
+                    size = 0
+                self._schemas.put(path, schema, size)
+
+            if path in self._checked or not schema.exists():
+                self.hits += 1
+                Stats.default().count("schemas.hit")
+            else:
+                self._checked.add(path)
+                if schema.update():
+                    self.misses += 1
+                    Stats.default().count("schemas.miss")
+                else:
+                    self.hits += 1
+                    Stats.default().count("schemas.hit")
+            return schema
+
+    def peek(self, path):
+        """Gets the schema for the path if it is loaded, None otherwise."""
+        return self._schemas.get(path)
+
+    def restore(self, path, state):
+        """Adds a schema loaded by another process (see Schema.state) unless
+        the path is loaded already. It is still checked for modifications
+        before it is used."""
+        with self._lock:
+            if path in self._schemas:
+                return
+            schema = self._create(path)
+            if isinstance(schema, Lazy_Schema):
+                return
+            schema.restore(state)
+            self._schemas.put(path, schema, state[0][1])
+
+    def max_size(self):
+        """Gets the maximum size of the cached schemas."""
+        return self._schemas.max_size
+
+    def set_max_size(self, size):
+        """Sets the maximum size of the cached schemas, None for no limit."""
+        self._schemas.max_size = size
+
+    def size(self):
+        """Gets the size of the cached schemas."""
+        return self._schemas.size()
+
+    def prune(self, ttl):
+        """Evicts the schemas not used within ttl seconds."""
+        self._schemas.prune(ttl)
+
+    def _evicted(self, path, schema):
+        self._checked.discard(path)
+        if isinstance(schema, Lazy_Schema):
+            schema.close()
+
+    def _file(self, path):
+        return os.path.join(self.directory, path) if self.directory else path
+
+    def _create(self, path):
+        if self.lazy_size is not None:
+            try:
+                if os.path.getsize(self._file(path)) >= self.lazy_size:
+                    return Lazy_Schema(path, self.directory)
+            except OSError:
+                pass
+        return Schema(path, directory=self.directory)
+
+    def stats(self):
+        """Returns the registry counters."""
+        return {
+            "schemas": len(self._schemas),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+class Dependency_Graph(object):
+    """Records the files every output was compiled from, so that outputs are
+    only recompiled when one of their inputs changed, also across runs.
+
+    Entries are keyed by out path and hold the schema and template of the
+    pair plus the (mtime, size) signatures of every file read while
+    compiling (schema, template and includes), taken before they were read,
+    and of the written output. An input modified within RACY_NS of being
+    recorded has no signature, it may change again without its signature
+    changing, so the output is stale in the next run.
+    """
+    VERSION = 1
+
+    def __init__(self, path=None):
+        self._path = path
+        self._outputs = {}
+        self._dirty = False
+        self._log = logging.getLogger(self.__class__.__name__)
+
+    def __repr__(self):
+        return "Dependency_Graph[path='{}', outputs='{}']".format(
+            self._path, len(self._outputs))
+
+    def load(self):
+        """Loads the graph saved by a previous run, if any."""
+        self._outputs = {}
+        self._dirty = False
+        if not self._path or not os.path.isfile(self._path):
+            return
+        try:
+            with open(self._path, "r") as file:
+                data = json.load(file)
+        except (OSError, ValueError) as ex:
+            self._log.warning("Could not load dependency graph: %s %s",
+                              self._path, ex)
+            return
+        if data.get("version") == Dependency_Graph.VERSION:
+            self._outputs = data.get("outputs", {})
+
+    def save(self):
+        """Saves the graph if it was modified."""
+        if not self._path or not self._dirty:
+            return
+        tmp_path = self._path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(tmp_path, "w") as file:
+                json.dump({"version": Dependency_Graph.VERSION,
+                           "outputs": self._outputs}, file, indent=1,
+                          sort_keys=True)
+            os.replace(tmp_path, self._path)
+            self._dirty = False
+        except OSError as ex:
+            self._log.error("Could not save dependency graph: %s %s",
+                            self._path, ex)
+
+    def inputs(self, out):
+        """Gets the files the output was compiled from."""
+        entry = self._outputs.get(out)
+        return list(entry["inputs"]) if entry else []
+
+    def is_written(self, out, digest, signature):
+        """Checks whether the output on disk is the one recorded with the
+        given content digest, without reading it."""
+        entry = self._outputs.get(out)
+        return entry is not None and entry.get("digest") == digest \
+            and Dependency_Graph._sig(signature(out)) == entry["out"]
+
+    def is_stale(self, out, schema, template, signature):
+        """Checks whether the output has to be recompiled, signature is a
+        function returning the current signature of a path."""
+        entry = self._outputs.get(out)
+        if entry is None or entry["schema"] != schema \
+                or entry["template"] != template:
+            return True
+        if Dependency_Graph._sig(signature(out)) != entry["out"]:
+            return True
+        for path, sig in entry["inputs"].items():
+            if Dependency_Graph._sig(signature(path)) != sig:
+                return True
+        return False
+
+    def record(self, out, schema, template, inputs, signature, digest=None):
+        """Records the inputs of a freshly compiled output, a dict of their
+        paths and the signatures they were read with. signature is a
+        function returning the current signature of the output."""
+        racy = time.time() - RACY_NS / 10 ** 9
+        self._outputs[out] = {
+            "schema": schema,
+            "template": template,
+            "digest": digest,
+            "inputs": {path: Dependency_Graph._sig(sig)
+                       if sig is not None and sig[0] < racy else None
+                       for path, sig in inputs.items()},
+            "out": Dependency_Graph._sig(signature(out))
+        }
+        self._dirty = True
+
+    def prune(self, outputs):
+        """Forgets the outputs that are not in the given set."""
+        for out in set(self._outputs) - set(outputs):
+            del self._outputs[out]
+            self._dirty = True
+            Stats.default().count("deps.evicted")
+
+    @staticmethod
+    def _sig(signature):
+        return list(signature) if signature is not None else None
+
+
+class Output_Cache(object):
+    """Keeps generated outputs on disk by content, so that checkouts,
+    worktrees and branches with the same inputs share them rather than
+    compiling them again.
+
+    Outputs are keyed by the sha1 of their template and schema, their out
+    path and the current project values (see key). The includes and
+    functions an output depends on are only known once it is compiled, so a
+    key holds up to ENTRIES outputs with the reads of their compilation (see
+    Compiler.reads). An entry is only used when every read gives the same
+    result again. Outputs are stored once by their sha1. Beyond max_size
+    bytes the least recently used files are removed (see prune).
+    """
+    VERSION = 1
+    ENTRIES = 8
+    MAX_SIZE = 256 * 1024 * 1024
+    _DEFAULT = None
+
+    def __init__(self, directory=None, max_size=MAX_SIZE):
+        self.max_size = max_size
+        self._directory = None
+        self._added = 0
+        self._lock = threading.Lock()
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.set_directory(directory)
+
+    def __repr__(self):
+        return "Output_Cache[directory='{}', max_size='{}']".format(
+            self._directory, self.max_size)
+
+    @staticmethod
+    def default():
+        """Returns the process wide output cache."""
+        if Output_Cache._DEFAULT is None:
+            Output_Cache._DEFAULT = Output_Cache()
+        return Output_Cache._DEFAULT
+
+    @staticmethod
+    def default_directory():
+        """Gets the directory of the user's output cache."""
+        return os.path.join(
+            os.environ.get("XDG_CACHE_HOME")
+            or os.path.join(os.path.expanduser("~"), ".cache"),
+            "codegen", "outputs")
+
+    def enabled(self):
+        """Checks whether outputs are cached, only with a directory."""
+        return self._directory is not None
+
+    def directory(self):
+        """Gets the directory the outputs are stored in."""
+        return self._directory
+
+    def set_directory(self, directory):
+        """Sets the directory the outputs are stored in, None disables the
+        cache."""
+        self._directory = os.path.abspath(directory) if directory else None
+
+    @staticmethod
+    def key(template, schema, out, current):
+        """Gets the key of an output from the sha1 of its template and
+        schema, its out path and the current project values."""
+        data = json.dumps([Output_Cache.VERSION, template, schema, out,
+                           sorted(current.items())])
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+    def get(self, key, context):
+        """Gets the (output, sha1, signatures) of the first entry of the key
+        whose reads give the same results in the context (see
+        Compile_Context), None if there is none. signatures holds the
+        dependencies of the output with their signatures, taken before the
+        reads were repeated (see Dependency_Graph.record)."""
+        if not self.enabled():
+            return None
+        manifest = self._manifest_path(key)
+        for entry in self._load(manifest):
+            try:
+                dependencies = {
+                    path: File(path, context.directory).signature()
+                    for path in entry["dependencies"]}
+                if not Output_Cache._repeat(entry["reads"], context):
+                    continue
+                path = self._object_path(entry["output"])
+                with open(path, "r") as file:
+                    output = file.read()
+            except (OSError, ValueError, KeyError, TypeError):
+                continue
+            for touched in (manifest, path):
+                try:
+                    os.utime(touched)
+                except OSError:
+                    pass
+            Stats.default().count("output_cache.hit")
+            return output, entry["output"], dependencies
+        Stats.default().count("output_cache.miss")
+        return None
+
+    def put(self, key, digest, reads, dependencies, path):
+        """Stores the output written to path, with the sha1 digest, as an
+        entry of the key."""
+        if not self.enabled():
+            return
+        entry = {"output": digest, "reads": reads,
+                 "dependencies": dependencies}
+        try:
+            target = self._object_path(digest)
+            if not os.path.isfile(target):
+                with open(path, "rb") as file:
+                    self._write(target, file.read())
+            with self._lock:
+                manifest = self._manifest_path(key)
+                entries = [entry] + [
+                    other for other in self._load(manifest)
+                    if isinstance(other, dict)
+                    and other.get("reads") != reads]
+                self._write(manifest, json.dumps(
+                    {"version": Output_Cache.VERSION,
+                     "entries": entries[:Output_Cache.ENTRIES]})
+                    .encode("utf-8"))
+        except OSError as ex:
+            self._log.warning("Could not cache output: %s %s", path, ex)
+
+    def prune(self):
+        """Removes the least recently used files beyond max_size, only when
+        outputs were stored since the last prune."""
+        if not self.enabled() or not self._added or self.max_size is None:
+            return
+        self._added = 0
+        files = []
+        for kind in ("manifests", "objects"):
+            for root, __, names in os.walk(
+                    os.path.join(self._directory, kind)):
+                for name in names:
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+        size = sum(file[1] for file in files)
+        for __, file_size, path in sorted(files):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= file_size
+            Stats.default().count("output_cache.evicted")
+
+    @staticmethod
+    def _repeat(reads, context):
+        """Checks whether the reads of an entry give the same results."""
+        for op, path, digest in reads["includes"]:
+            text = Include_Cache.default().read(path, op == "@@!",
+                                                context.directory)
+            if text is None and digest is not None or text is not None \
+                    and hashlib.sha1(text.encode("utf-8")).hexdigest() \
+                    != digest:
+                return False
+        for path, arg, result in reads["calls"]:
+            try:
+                func = context.resolve(list(path))
+            except ValueError:
+                return False
+            if isinstance(func, str):
+                value = func
+            elif arg is not None:
+                value = func(arg)
+            else:
+                value = context.call(path, func)
+            if value != result:
+                return False
+        return True
+
+    def _load(self, manifest):
+        try:
+            with open(manifest, "r") as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return []
+        if not isinstance(data, dict) \
+                or data.get("version") != Output_Cache.VERSION:
+            return []
+        return data.get("entries") or []
+
+    def _write(self, path, contents):
+        """Writes the file atomically, as other processes may share it."""
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp",
+                                        dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(contents)
+            os.replace(tmp_path, path)
+        except BaseException:
+            File.discard(tmp_path)
+            raise
+        self._added += len(contents)
+
+    def _manifest_path(self, key):
+        return os.path.join(self._directory, "manifests", key[:2],
+                            key + ".json")
+
+    def _object_path(self, digest):
+        return os.path.join(self._directory, "objects", digest[:2], digest)
+
+
+class Snapshot(object):
+    """Keeps the parsed schemas and tokenized templates of a project in one
+    file, so that a new process loads them with a single read rather than
+    parsing every schema and tokenizing every template.
+
+    Schemas are stored with the (mtime, size) signature they were parsed
+    at and are parsed again once their file changed, templates are keyed by
+    their content. The file is only rewritten when a schema or template
+    changed since it was loaded or saved.
+    """
+    VERSION = 1
 
-class Project(Schema):
-    """Contains configs to generate project files."""
     def __init__(self, path):
+        self._path = path
+        self._schemas = {}
+        self._templates = set()
+        self._log = logging.getLogger(self.__class__.__name__)
+
+    def __repr__(self):
+        return "Snapshot[path='{}', schemas='{}', templates='{}']".format(
+            self._path, len(self._schemas), len(self._templates))
+
+    def load(self):
+        """Loads the snapshot. Returns the {path: (signature, json)} of the
+        schemas (see Schema.state) and the parsed templates, both empty if
+        there is no valid snapshot."""
+        self._schemas = {}
+        self._templates = set()
+        try:
+            with open(self._path, "rb") as file:
+                data = file.read()
+        except OSError:
+            return {}, []
+        try:
+            with Stats.default().timer("read"):
+                version, schemas, templates = pickle.loads(data)
+        except (pickle.PickleError, EOFError, ValueError, TypeError,
+                AttributeError, ImportError) as ex:
+            self._log.warning("Could not load snapshot: %s %s",
+                              self._path, ex)
+            return {}, []
+        if version != Snapshot.VERSION:
+            return {}, []
+        self._schemas = {path: state[0] for path, state in schemas.items()}
+        self._templates = Snapshot._contents(templates)
+        return schemas, templates
+
+    def save(self, schemas, templates):
+        """Writes the snapshot of the schemas and parsed templates, see load,
+        if they changed since the last load or save. Returns True if it was
+        written."""
+        signatures = {path: state[0] for path, state in schemas.items()}
+        contents = Snapshot._contents(templates)
+        if signatures == self._schemas and contents == self._templates:
+            return False
+        tmp_path = self._path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(tmp_path, "wb") as file:
+                pickle.dump((Snapshot.VERSION, schemas, templates), file,
+                            pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path)
+        except (OSError, pickle.PickleError) as ex:
+            self._log.error("Could not save snapshot: %s %s", self._path, ex)
+            return False
+        self._schemas = signatures
+        self._templates = contents
+        Stats.default().count("snapshot.written")
+        return True
+
+    @staticmethod
+    def _contents(templates):
+        return {(hash(parsed.content), len(parsed.content))
+                for parsed in templates}
+
+
+class Record_Handler(logging.Handler):
+    """Collects log records so they can be replayed in another process."""
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+    @staticmethod
+    def replay(records):
+        """Passes the records on to the handlers of this process."""
+        for record in records:
+            logging.getLogger(record.name).handle(record)
+
+
+class Compile_Job(object):
+    """A schema and template pair to compile, in this or a worker process."""
+    _registries = {}
+    _run = None
+    _lazy_size = None
+    _limits = {}
+
+    def __init__(self, schema, template, functions=None, directory=None,
+                 run=None, started=None):
+        self.schema = schema
+        self.template = template
+        self.functions = functions if functions is not None else {}
+        self.directory = directory
+        self.run = run
+        self.started = started
+        self.pair = None
+        self.out = None
+        self.compiled = None
+        self.tmp_path = None
+        self.digest = None
+        self.dependencies = []
+        self.signatures = {}
+        self.reads = None
+        self.key = None
+        self.cached = False
+        self.error = None
+        self.elapsed = 0
+        self.records = []
+        self.git_calls = 0
+        self.stats = None
+
+    def __repr__(self):
+        return "Compile_Job[schema='{}', template='{}']".format(
+            self.schema, self.template)
+
+    def execute(self, registry):
+        """Compiles the pair, a ValueError is stored rather than raised. With
+        an out file the output is streamed to a temporary file next to it
+        (see File.write_temp), otherwise it is kept in compiled. Paths are
+        relative to the directory of the job."""
+        context = Compile_Context(self.directory, self.functions,
+                                  self.started)
+        template = File(self.template, self.directory)
+        git_calls = Git_Helper.subprocess_calls
+        start_time = time.time()
+        try:
+            compiler = Compiler(registry.get(self.schema), context=context)
+            if self.out is not None:
+                self.tmp_path, self.digest = self.out.write_temp(
+                    compiler.compile_iter(template))
+            else:
+                self.compiled = compiler.compile(template)
+        except ValueError as ex:
+            self.error = str(ex)
+        except IOError as ex:
+            self.error = "Could not write {}: {}".format(self.out.path(), ex)
+        else:
+            self.dependencies = compiler.dependencies()
+            self.signatures = compiler.signatures()
+            self.reads = compiler.reads()
+        self.elapsed = time.time() - start_time
+        if self.error is None:
+            Stats.default().compiled(self.schema, self.template,
+                                     self.elapsed, compiler.tokens())
+        self.git_calls = Git_Helper.subprocess_calls - git_calls
+        return self
+
+    def restore(self, output, digest, signatures):
+        """Takes the output from the output cache rather than compiling it,
+        writing it to a temporary file next to the out file. signatures
+        holds its dependencies (see Output_Cache.get). Returns False if the
+        output does not match its digest."""
+        self.tmp_path, self.digest = self.out.write_temp([output])
+        if self.digest != digest:
+            File.discard(self.tmp_path)
+            self.tmp_path = None
+            return False
+        self.dependencies = sorted(signatures)
+        self.signatures = signatures
+        self.cached = True
+        return True
+
+    @staticmethod
+    def init_worker(level, cache_dir, stats=False, lazy_size=None,
+                    compiled=False, limits=None):
+        """Initialises a worker process, limits are the cache limits (see
+        Codegen.limits)."""
+        logging.getLogger().setLevel(level)
+        Compile_Job._limits = limits or {}
+        Template_Cache.default().set_max_size(
+            Compile_Job._limits.get("templates"))
+        if "includes" in Compile_Job._limits:
+            Include_Cache.default().set_max_size(
+                Compile_Job._limits["includes"])
+        if "renders" in Compile_Job._limits:
+            Render_Cache.default().set_max_size(
+                Compile_Job._limits["renders"])
+        Compile_Job._lazy_size = lazy_size
+        Template_Cache.default().set_directory(cache_dir)
+        Template_Cache.default().set_compiled(compiled)
+        Stats.default().enable(stats)
+
+    @staticmethod
+    def run_in_worker(job):
+        """Executes the job in a worker process, capturing its log records."""
+        if Compile_Job._run != (job.run, job.started):
+            ttl = Compile_Job._limits.get("ttl")
+            for registry in Compile_Job._registries.values():
+                registry.begin_run()
+                if ttl is not None:
+                    registry.prune(ttl)
+            if ttl is not None:
+                Template_Cache.default().prune(ttl)
+                Include_Cache.default().prune(ttl)
+                Render_Cache.default().prune(ttl)
+            FunctionResolver.begin_run(job.started)
+            Compile_Job._run = (job.run, job.started)
+        registry = Compile_Job._registries.get(job.directory)
+        if registry is None:
+            registry = Schema_Registry(Compile_Job._lazy_size,
+                                       Compile_Job._limits.get("schemas"),
+                                       job.directory)
+            Compile_Job._registries[job.directory] = registry
+
+        root = logging.getLogger()
+        handlers = root.handlers
+        handler = Record_Handler()
+        root.handlers = [handler]
+        stats = Stats.default()
+        stats.reset()
+        try:
+            job.execute(registry)
+        finally:
+            root.handlers = handlers
+        job.records = handler.records
+        if stats.enabled:
+            job.stats = stats.snapshot()
+        return job
+
+
+class Glob_Index(object):
+    """Expands glob patterns against cached directory listings.
+
+    Patterns expand as glob.glob(pattern, recursive=True) does, in the same
+    order. A listing is checked against the mtime of its directory at most
+    once per run (see begin_run) and only rescanned when the mtime changed
+    or the listing was dropped by invalidate.
+    """
+
+    def __init__(self):
+        self._listings = {}
+        self._checked = set()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "Glob_Index[directories='{}', hits='{}', misses='{}']".format(
+            len(self._listings), self.hits, self.misses)
+
+    def begin_run(self):
+        """Starts a new run, directories are checked for changes again."""
+        self._checked = set()
+
+    def invalidate(self, paths):
+        """Drops the listings of the given absolute paths and of their
+        directories, such as the paths reported by a watcher."""
+        for path in paths:
+            self._listings.pop(path, None)
+            self._listings.pop(os.path.dirname(path), None)
+
+    def prune(self):
+        """Drops the listings of the directories not checked in this run,
+        as no pattern matched into them."""
+        for path in set(self._listings) - self._checked:
+            del self._listings[path]
+            Stats.default().count("globs.evicted")
+
+    def directories(self):
+        """Gets the absolute paths of the listed directories."""
+        return set(self._listings)
+
+    def glob(self, pattern, directory=None):
+        """Gets the paths matching the pattern, relative to the directory
+        (the working directory by default) if the pattern is."""
+        paths = self._glob(pattern, os.path.abspath(directory or os.curdir),
+                           False)
+        if not pattern or pattern[:2] == "**":
+            paths = [path for path in paths if path]
+        return list(paths)
+
+    def _glob(self, pattern, base, dironly):
+        dirname, basename = os.path.split(pattern)
+        if not glob.has_magic(pattern):
+            if basename:
+                if os.path.lexists(Glob_Index._join(base, pattern)):
+                    yield pattern
+            elif os.path.isdir(Glob_Index._join(base, dirname)):
+                yield pattern
+            return
+        if not dirname:
+            yield from self._match(dirname, basename, base, dironly)
+            return
+        if dirname != pattern and glob.has_magic(dirname):
+            dirs = self._glob(dirname, base, True)
+        else:
+            dirs = [dirname]
+        for dirname in dirs:
+            if glob.has_magic(basename):
+                names = self._match(dirname, basename, base, dironly)
+            elif basename:
+                names = [basename] if os.path.lexists(Glob_Index._join(
+                    base, os.path.join(dirname, basename))) else []
+            else:
+                names = [basename] if os.path.isdir(
+                    Glob_Index._join(base, dirname)) else []
+            for name in names:
+                yield os.path.join(dirname, name)
+
+    @staticmethod
+    def _join(base, path):
+        """Joins a path onto the base, an empty path stays empty."""
+        return os.path.join(base, path) if path else path
+
+    def _match(self, dirname, pattern, base, dironly):
+        """Matches the names in the directory against a pattern without
+        separators, '**' matching the directory and everything below it."""
+        if pattern == "**":
+            yield ""
+            yield from self._walk(dirname, base, dironly)
+            return
+        names = self._names(dirname, base, dironly)
+        if pattern[0] != ".":
+            names = [name for name in names if name[0] != "."]
+        yield from fnmatch.filter(names, pattern)
+
+    def _walk(self, dirname, base, dironly):
+        for name, is_dir in self._listing(dirname, base):
+            if name[0] == "." or dironly and not is_dir:
+                continue
+            yield name
+            if is_dir:
+                for path in self._walk(os.path.join(dirname, name), base,
+                                       dironly):
+                    yield os.path.join(name, path)
+
+    def _names(self, dirname, base, dironly):
+        return [name for name, is_dir in self._listing(dirname, base)
+                if is_dir or not dironly]
+
+    def _listing(self, dirname, base):
+        """Gets the (name, is_dir) entries of the directory in scandir order,
+        empty if it cannot be listed."""
+        path = os.path.normpath(os.path.join(base, dirname))
+        listing = self._listings.get(path)
+        if listing is not None and path in self._checked:
+            self.hits += 1
+            Stats.default().count("globs.hit")
+            return listing[1]
+        self._checked.add(path)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            self._listings.pop(path, None)
+            return []
+        if listing is not None and listing[0] == mtime:
+            self.hits += 1
+            Stats.default().count("globs.hit")
+            return listing[1]
+
+        self.misses += 1
+        Stats.default().count("globs.miss")
+        entries = []
+        try:
+            with os.scandir(path) as scan:
+                for entry in scan:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    entries.append((entry.name, is_dir))
+        except OSError:
+            return []
+        # A directory changed within the mtime resolution may change again
+        # without a new mtime, it is rescanned on the next run.
+        if time.time_ns() - mtime > RACY_NS:
+            self._listings[path] = (mtime, entries)
+        else:
+            self._listings[path] = (None, entries)
+        return entries
+
+
+class Project(Schema):
+    """Contains configs to generate project files.
+
+    The paths in the project are relative to its directory, the registry
+    must resolve schema paths relative to it too (see Schema_Registry).
+    """
+    def __init__(self, path, registry=None, executor=None):
         if not isinstance(path, str):
             raise ValueError("Project() - Expected str:", path)
 
         Schema.__init__(self, path)
 
-        self._filestore = {
-            "schema": {},
-            "template": {},
-            "out": {}
-        }
-        self._recent = []
-        self._owd = None
-        self._updated_files = {}
+        self._signatures = {}
+        self._digests = {}
+        self._written = []
+        self._unchanged = []
+        self._fresh = {}
+        self._failures = 0
+        self._started = None
+        self._git_calls = 0
+        self._dir = os.path.dirname(os.path.abspath(path))
+        self._registry = registry if registry is not None \
+            else Schema_Registry(directory=self._dir)
+        self._executor = executor
+        self._runs = 0
+        self._pairs = {}
+        self._outputs = set()
+        self._deps = None
+        self._snapshot = None
+        self._use_snapshot = False
+        self._globs = Glob_Index()
         self._log = logging.getLogger(self.__class__.__name__)
 
     def __repr__(self):
         return "Project[path='{}']".format(self.path())
 
-    def update(self):
-
-        FunctionResolver.PROJECT_FUNCTIONS["current"]["project"] = \
-            self.basename()
+    def update(self, changed=None):
+        """Updates the outputs of the project. Given the set of absolute
+        paths that changed since the last update, only the pairs depending
+        on them are updated where possible."""
+        if changed is not None:
+            self._globs.invalidate(changed)
+            pairs = self._changed_pairs(changed)
+            if pairs is not None:
+                if pairs:
+                    self._update_pairs(pairs)
+                return
 
         super().update()
         output = self.json("output")
         if output is not None:
-            self._cd_project_dir()
-            self._updated_files = {}
+            self._begin_run()
+            self._runs += 1
+            self._pairs = {}
+            self._outputs = set()
+            jobs = []
             for i, item in enumerate(output):
                 try:
-                    self._process_output(item)
+                    jobs += self._process_output(item)
                 except ValueError as ex:
+                    self._failures += 1
                     self._log.error("Failed to process output item [%s] "
                                     "in project file (%s) =>\t\n%s:\t\n%s",
                                     i, self.path(), str(ex), item)
-            self._cd_owd()
+            self._compile_jobs(jobs)
+            self._deps.prune(self._outputs)
+            self._globs.prune()
+            self._end_run()
+            self._log.debug("[%s]: schema registry %s, %s git subprocess "
+                            "calls", self.path(), self._registry.stats(),
+                            self._git_calls)
 
     def _process_output(self, item):
         if "schema" not in item:
@@ -427,86 +2436,311 @@ class Project(Schema):
         if "out" not in item:
             raise ValueError("Malformed output item, missing out.")
 
-        schemas = glob.glob(item["schema"])
-        templates = glob.glob(item["template"])
+        with Stats.default().timer("glob"):
+            schemas = self._globs.glob(item["schema"], self._dir)
+            templates = self._globs.glob(item["template"], self._dir)
         out = item["out"]
 
+        jobs = []
         for schema in schemas:
             for template in templates:
                 try:
-                    self._upsert_group(schema, template, out)
+                    job = self._upsert_group(schema, template, out)
                 except ValueError as ex:
-                    self._log.error("Failed to process output item "
-                                    "in project file (%s) =>\t\n%s:\t\n%s"
-                                    "\nMessage: %s",
-                                    self.path(), schema, template, str(ex))
+                    self._log_failure(schema, template, str(ex))
+                else:
+                    if job is not None:
+                        jobs.append(job)
+        return jobs
+
+    def watch_dirs(self):
+        """Gets the directories containing the files of the project and the
+        directories listed to expand its patterns."""
+        dirs = {self._dir} | self._globs.directories()
+        for paths in self._pairs.values():
+            dirs.update(os.path.dirname(path) for path in paths)
+        for item in self.json("output") or []:
+            for key in ("schema", "template"):
+                if isinstance(item, dict) and key in item:
+                    dirs.add(self._abspath(Project._static_dir(item[key])))
+        return dirs
+
+    @staticmethod
+    def _static_dir(pattern):
+        """Gets the leading directories of a glob pattern without magic."""
+        parts = []
+        for part in os.path.dirname(pattern).split(os.sep):
+            if glob.has_magic(part):
+                break
+            parts.append(part)
+        return os.sep.join(parts)
+
+    def _abspath(self, path):
+        return os.path.normpath(os.path.join(self._dir, path))
+
+    def _changed_pairs(self, changed):
+        """Maps changed paths onto the pairs depending on them. Returns None
+        when a full update is required (project file changed, files added or
+        removed, or a changed file is not a known input or output). The
+        temporary files and outputs written by the project are skipped."""
+        dirs = self.watch_dirs()
+        pairs = set()
+        for path in changed:
+            if File.is_temp(path):
+                continue
+            if path in self._fresh:
+                if self._fresh.pop(path) == File(path).signature():
+                    continue
+            if path == os.path.abspath(self.path()):
+                return None
+            found = False
+            for pair, paths in self._pairs.items():
+                if path in paths:
+                    pairs.add(pair)
+                    found = True
+            if found and not os.path.isfile(path):
+                return None
+            if not found and os.path.dirname(path) in dirs:
+                return None
+        return pairs
+
+    def _update_pairs(self, pairs):
+        self._begin_run()
+        self._runs += 1
+        jobs = []
+        for schema, template, out in sorted(pairs):
+            try:
+                job = self._upsert_group(schema, template, out)
+            except ValueError as ex:
+                self._log_failure(schema, template, str(ex))
+            else:
+                if job is not None:
+                    jobs.append(job)
+        self._compile_jobs(jobs)
+        self._end_run()
+
+    def written(self):
+        """Gets the outputs written and the outputs found unchanged by the
+        last update."""
+        return list(self._written), list(self._unchanged)
+
+    def failures(self):
+        """Gets the number of output items that failed in the last update."""
+        return self._failures
+
+    def _begin_run(self):
+        self._signatures = {}
+        self._digests = {}
+        self._written = []
+        self._unchanged = []
+        self._failures = 0
+        self._git_calls = 0
+        self._started = FunctionResolver.begin_run()
+        self._registry.begin_run()
+        self._globs.begin_run()
+        if self._deps is None:
+            self._deps = Dependency_Graph(self._cache_path("deps", ".json"))
+            self._deps.load()
+            if self._use_snapshot:
+                self._snapshot = Snapshot(
+                    self._cache_path("snapshots", ".pickle"))
+                self._restore_snapshot()
+
+    def _end_run(self):
+        self._deps.save()
+        if self._snapshot is not None:
+            self._save_snapshot()
+        if self._written or self._unchanged:
+            self._log.info("[%s]: %s outputs written, %s unchanged",
+                           self.path(), len(self._written),
+                           len(self._unchanged))
+
+    def _cache_path(self, kind, extension):
+        """Gets the path the dependency graph or snapshot (the kind) is saved
+        to, in the template cache directory if one is set, next to the
+        project otherwise."""
+        directory = Template_Cache.default().directory() \
+            or os.path.join(self._dir, ".codegen-cache")
+        digest = hashlib.sha1(
+            os.path.abspath(self.path()).encode("utf-8")).hexdigest()
+        return os.path.join(os.path.abspath(directory), kind, "{}-{}{}"
+                            .format(self.basename(), digest[:8], extension))
+
+    def _restore_snapshot(self):
+        schemas, templates = self._snapshot.load()
+        for path, state in schemas.items():
+            self._registry.restore(path, state)
+        for parsed in templates:
+            Template_Cache.default().restore(parsed)
+        self._log.debug("[%s]: restored %s schemas and %s templates from %s",
+                        self.path(), len(schemas), len(templates),
+                        self._snapshot)
+
+    def _save_snapshot(self):
+        """Saves the schemas of the pairs and their templates and includes
+        to the snapshot. Schemas modified within the mtime resolution are
+        left out, they may change again without a new signature."""
+        racy = time.time() - RACY_NS / 10 ** 9
+        schemas = {}
+        paths = set()
+        for schema_path, template_path, __ in self._pairs:
+            paths.add(template_path)
+            schema = self._registry.peek(schema_path)
+            state = schema.state() if schema is not None else None
+            if state is not None and state[0][0] < racy:
+                schemas[schema_path] = state
+        for out in self._outputs:
+            paths.update(self._deps.inputs(out))
+        templates = []
+        for path in sorted(paths - {pair[0] for pair in self._pairs}):
+            content = Include_Cache.default().read(path, directory=self._dir)
+            if content and Token.REGEX_OPERATOR.search(content):
+                templates.append(Template_Cache.default().parse(content))
+        self._snapshot.save(schemas, templates)
+
+    def _file_signature(self, path):
+        """Gets the signature of a file, at most one stat per file and run."""
+        if path not in self._signatures:
+            self._signatures[path] = File(path, self._dir).signature()
+        return self._signatures[path]
+
+    def _file_digest(self, path):
+        """Gets the sha1 of a file, hashing every file at most once per
+        run."""
+        if path not in self._digests:
+            self._digests[path] = File(path, self._dir).digest()
+        return self._digests[path]
+
+    def _log_failure(self, schema_path, template_path, message):
+        self._failures += 1
+        self._log.error("Failed to process output item "
+                        "in project file (%s) =>\t\n%s:\t\n%s"
+                        "\nMessage: %s",
+                        self.path(), schema_path, template_path, message)
 
     def _upsert_group(self, schema_path, template_path, out_path):
-        schema = Schema(schema_path)
-        template = File(template_path)
+        pair = (schema_path, template_path, out_path)
+        self._pairs[pair] = (self._abspath(schema_path),
+                             self._abspath(template_path))
+        schema = self._registry.get(schema_path)
+        template = File(template_path, self._dir)
 
         if not schema.exists():
             raise ValueError("Schema does not exist: %s", schema.path())
         if not template.exists():
             raise ValueError("Template does not exist: %s", template.path())
 
-        out = File(Compiler(schema).compile(out_path))
-        if not out.exists():
-            out.touch()
-
-        su = self._upsert_file("schema", schema)
-        tu = self._upsert_file("template", template)
-        ou = self._upsert_file("out", out)
-
-        if su or tu or ou:
-            FunctionResolver.PROJECT_FUNCTIONS["current"]["schema"] = \
-                schema.path()
-            FunctionResolver.PROJECT_FUNCTIONS["current"]["template"] = \
-                template.path()
-
-            start_time = time.time()
-            compiled = Compiler(schema).compile(template)
-            self.log.info("[%s]: [%s] compiled with [%s] in %s seconds",
-                          self.path(), schema.path(), template.path(),
-                          time.time() - start_time)
-
-            out.write(compiled)
-            self._upsert_file("out", out, force_update=True)
-        return True
-
-    def _upsert_file(self, ftype, file, force_update=False):
-        if not force_update and file.path() in self._updated_files:
-            return self._updated_files[file.path()]
-
-        updated = True
-        if file.path() not in self._filestore[ftype]:
-            self._filestore[ftype][file.path()] = {
-                "file": file,
-                "mtime": file.mtime()
-            }
+        functions = {
+            "project": self.basename(),
+            "schema": schema.path(),
+            "template": template.path()
+        }
+        context = Compile_Context(self._dir, functions, self._started)
+        out = File(Compiler(schema, context=context).compile(out_path),
+                   self._dir)
+        self._outputs.add(out.path())
+        paths = [out.path()] + self._deps.inputs(out.path())
+        self._pairs[pair] += tuple(self._abspath(path) for path in paths)
+
+        if not self._deps.is_stale(out.path(), schema.path(), template.path(),
+                                   self._file_signature):
+            Stats.default().count("outputs.up_to_date")
+            return None
+
+        job = Compile_Job(schema.path(), template.path(), functions,
+                          self._dir, (self.path(), self._runs), self._started)
+        job.pair = pair
+        job.out = out
+        cache = Output_Cache.default()
+        if cache.enabled():
+            job.key = Output_Cache.key(self._file_digest(template.path()),
+                                       self._file_digest(schema.path()),
+                                       out.path(), functions)
+            cached = cache.get(job.key, context)
+            if cached is not None:
+                try:
+                    job.restore(*cached)
+                except IOError as ex:
+                    self._log.warning("Could not restore %s: %s",
+                                      out.path(), ex)
+        return job
+
+    def _compile_jobs(self, jobs):
+        """Compiles the jobs, in worker processes if there is an executor,
+        and writes the results in order. Jobs restored from the output cache
+        are only written."""
+        pending = [job for job in jobs if not job.cached]
+        if self._executor is None or len(pending) < 2:
+            results = (job.execute(self._registry) for job in pending)
         else:
-            mtime = file.mtime()
-            if self._filestore[ftype][file.path()]["mtime"] < mtime:
-                self._filestore[ftype][file.path()]["mtime"] = mtime
+            results = self._executor.map(Compile_Job.run_in_worker, pending)
+
+        for job in jobs:
+            if not job.cached:
+                job = next(results)
+            Record_Handler.replay(job.records)
+            self._git_calls += job.git_calls
+            if job.stats is not None:
+                Stats.default().merge(job.stats)
+            if job.error is not None:
+                self._log_failure(job.schema, job.template, job.error)
+                continue
+
+            if job.cached:
+                self.log.info("[%s]: [%s] with [%s] restored from the "
+                              "output cache", self.path(), job.schema,
+                              job.template)
             else:
-                updated = False
-
-        self._updated_files[file.path()] = updated
-        return updated
-
-    def _cd_project_dir(self):
-        self._owd = os.getcwd()
-        if self.parent_dir():
-            os.chdir(self.parent_dir())
-
-    def _cd_owd(self):
-        if self._owd is not None:
-            os.chdir(self._owd)
-            self._owd = None
+                self.log.info("[%s]: [%s] compiled with [%s] in %s seconds",
+                              self.path(), job.schema, job.template,
+                              job.elapsed)
+            out = job.out.path()
+            if self._deps.is_written(out, job.digest, self._file_signature) \
+                    or job.out.digest() == job.digest:
+                File.discard(job.tmp_path)
+                self._unchanged.append(out)
+                Stats.default().count("outputs.unchanged")
+                self.log.debug("[%s]: [%s] is unchanged, not written",
+                               self.path(), out)
+            else:
+                try:
+                    job.out.replace(job.tmp_path)
+                except IOError as ex:
+                    self._log_failure(job.schema, job.template,
+                                      "Could not write {}: {}".format(out, ex))
+                    continue
+                self._written.append(out)
+                self._signatures.pop(out, None)
+                self._fresh[self._abspath(out)] = self._file_signature(out)
+                Stats.default().count("outputs.written")
+            self._deps.record(out, job.schema, job.template,
+                              job.signatures, self._file_signature,
+                              job.digest)
+            if job.key is not None and not job.cached:
+                Output_Cache.default().put(job.key, job.digest, job.reads,
+                                           job.dependencies,
+                                           self._abspath(out))
+            self._pairs[job.pair] = self._pairs[job.pair][:3] + tuple(
+                self._abspath(path) for path in job.dependencies)
+
+    def set_executor(self, executor):
+        """Sets the executor used to compile output items in parallel."""
+        self._executor = executor
+
+    def use_snapshot(self, enabled=True):
+        """Restores the parsed schemas and templates from a snapshot on the
+        first update and saves them after every update (see Snapshot)."""
+        self._use_snapshot = enabled
 
 
 class Schema_Stack(object):
-    """Manages the scope of a schema as a stack."""
+    """Manages the scope of a schema as a stack.
+
+    Each frame holds its scope and the schema value it resolves to, so
+    relative lookups continue from the node of the frame below. While trace
+    is a list, the scope and Render_Cache.fingerprint of every token pushed
+    are appended to it.
+    """
     def __init__(self, schema):
         if not isinstance(schema, Schema):
             raise ValueError(
@@ -514,6 +2748,8 @@ class Schema_Stack(object):
 
         self._schema = schema
         self._scopes = [[]]
+        self._nodes = [(False, None)]
+        self.trace = None
 
     def push(self, token):
         """Push a token onto the stack."""
@@ -532,20 +2768,47 @@ class Schema_Stack(object):
                     else:
                         scope.append(seg)
 
+            found, var = self._nodes[-1]
+            if token.operator == "$$" and found:
+                node = Schema.walk(scope, var, len(self._scopes[-1]))
+            else:
+                node = self._schema.node(scope)
+
             self._scopes.append(scope)
+            self._nodes.append(node)
+            if self.trace is not None:
+                self.trace.append((tuple(scope), Render_Cache.fingerprint(
+                    node[1], token.expansion is not None) if node[0]
+                    else None))
         elif isinstance(token, int):
             scope = self._scopes[-1].copy()
             scope.append(token)
+            found, var = self._nodes[-1]
+            if found and isinstance(var, list) and 0 <= token < len(var):
+                node = (True, var[token])
+            else:
+                node = self._schema.node(scope)
+
             self._scopes.append(scope)
+            self._nodes.append(node)
         else:
             raise ValueError("Compiler._push - Expected list or Token:", token)
 
     def pop(self):
         """Pops the top token from the stack."""
         self._scopes.pop()
+        self._nodes.pop()
+
+    def node(self):
+        """Gets the schema value associated with the top of the stack as a
+        (found, value) tuple, without logging when it is not found."""
+        return self._nodes[-1]
 
     def value(self):
         """Gets the schema value associated with the top of the stack."""
+        found, var = self._nodes[-1]
+        if found:
+            return var
         return self._schema.value(self._scopes[-1])
 
     def curr_scope(self):
@@ -557,86 +2820,1082 @@ class Schema_Stack(object):
         return self._schema.path()
 
 
+class Parsed_Template(object):
+    """A template scanned once into literal and token nodes.
+
+    Tokens are value ($$, !!, ^^), section (a value token with an expansion,
+    which becomes a loop or a conditional depending on the schema value it
+    resolves to), function (%%) or include (@@, @@!) nodes. Expansion bodies
+    are parsed into child templates, so the result is a tree that can be
+    compiled against any schema.
+    """
+    def __init__(self, content, cache=None):
+        if not isinstance(content, str):
+            raise ValueError("Parsed_Template() - Expected str: ", content)
+
+        self.content = content
+        self.tokens = []
+        self.code = None
+
+        lexer = Token_Lexer(content)
+        token = lexer.find()
+        while token is not None:
+            token.contained = token.is_contained(content)
+            if token.expansion is not None:
+                token.body = cache.parse(token.expansion) if cache \
+                    else Parsed_Template(token.expansion)
+            self.tokens.append(token)
+            token = lexer.find(token.end)
+
+    def __repr__(self):
+        return "Parsed_Template[length='{}', tokens='{}']".format(
+            len(self.content), len(self.tokens))
+
+    def __getstate__(self):
+        # generated code (see Template_Code) is not pickled
+        state = self.__dict__.copy()
+        state["code"] = None
+        return state
+
+    def nodes(self):
+        """Yields the literal (str) and token nodes in template order."""
+        pos = 0
+        for token in self.tokens:
+            if token.start > pos:
+                yield self.content[pos:token.start]
+            yield token
+            pos = token.end
+        if pos < len(self.content):
+            yield self.content[pos:]
+
+
+class Lru_Store(object):
+    """Keeps cached values in least recently used order.
+
+    Every value has a size, in bytes as estimated by its cache. Beyond
+    max_size the least recently used values are evicted, and prune evicts
+    those not used within a ttl. Evictions are counted as '<name>.evicted'
+    and on_evict is called with the key and value of every evicted value.
+    The store can be shared by threads.
+    """
+    def __init__(self, name, max_size=None, on_evict=None):
+        self.name = name
+        self.max_size = max_size
+        self._on_evict = on_evict
+        self._items = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return "Lru_Store[name='{}', items='{}', size='{}']".format(
+            self.name, len(self._items), self._size)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def size(self):
+        """Gets the total size of the values."""
+        return self._size
+
+    def get(self, key):
+        """Gets the value of the key, None if there is none."""
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            item[2] = time.monotonic()
+            return item[0]
+
+    def put(self, key, value, size):
+        """Stores the value of the key, evicting beyond max_size."""
+        with self._lock:
+            self.pop(key)
+            self._items[key] = [value, size, time.monotonic()]
+            self._size += size
+            while self.max_size is not None and self._size > self.max_size \
+                    and len(self._items) > 1:
+                self._evict()
+
+    def pop(self, key):
+        """Removes the value of the key, returns it or None."""
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return None
+            self._size -= item[1]
+            return item[0]
+
+    def values(self):
+        """Gets the values, least recently used first."""
+        with self._lock:
+            return [item[0] for item in self._items.values()]
+
+    def clear(self):
+        """Removes all values, without calling on_evict."""
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+    def prune(self, ttl):
+        """Evicts the values not used within the last ttl seconds."""
+        expired = time.monotonic() - ttl
+        with self._lock:
+            while self._items \
+                    and next(iter(self._items.values()))[2] < expired:
+                self._evict()
+
+    def _evict(self):
+        key, (value, size, __) = self._items.popitem(last=False)
+        self._size -= size
+        Stats.default().count(self.name + ".evicted")
+        if self._on_evict is not None:
+            self._on_evict(key, value)
+
+
+class Include_Cache(object):
+    """Caches the contents of the files included by @@ tokens.
+
+    During a run (see begin_run) a file is checked at most once, later reads
+    return the cached contents. A file is only read again when its mtime or
+    size changed, or when it changed within the mtime resolution of the
+    last read. Outside of a run every read checks the file. The least
+    recently used files are evicted beyond max_size bytes of contents.
+    """
+    _DEFAULT = None
+
+    def __init__(self, max_size=32 * 1024 * 1024):
+        self._files = Lru_Store("includes", max_size)
+        self._checked = None
+
+    def __repr__(self):
+        return "Include_Cache[files='{}', size='{}', max_size='{}']".format(
+            len(self._files), self._files.size(), self._files.max_size)
+
+    @staticmethod
+    def default():
+        """Returns the process wide include cache."""
+        if Include_Cache._DEFAULT is None:
+            Include_Cache._DEFAULT = Include_Cache()
+        return Include_Cache._DEFAULT
+
+    def max_size(self):
+        """Gets the maximum size of the cached contents."""
+        return self._files.max_size
+
+    def set_max_size(self, size):
+        """Sets the maximum size of the cached contents, None for no
+        limit."""
+        self._files.max_size = size
+
+    def size(self):
+        """Gets the size of the cached contents."""
+        return self._files.size()
+
+    def begin_run(self):
+        """Starts a new run, files are checked for modifications again."""
+        self._checked = set()
+
+    def invalidate(self, path):
+        """Drops the cached contents of a file."""
+        self._files.pop(os.path.abspath(path))
+
+    def prune(self, ttl):
+        """Drops the contents of files not read within ttl seconds."""
+        self._files.prune(ttl)
+
+    def clear(self):
+        """Empties the cache."""
+        self._files.clear()
+
+    def read(self, path, cut_last_char=False, directory=None):
+        """Reads the contents of the file, relative to the directory (the
+        working directory by default), None if it cannot be read, without
+        its last character given cut_last_char."""
+        return self.read_signed(path, cut_last_char, directory)[0]
+
+    def read_signed(self, path, cut_last_char=False, directory=None):
+        """Reads the file as read() does, returns its contents and the
+        signature (see File.signature) of the file they were read from,
+        None if it changed within RACY_NS of being read."""
+        if directory:
+            path = os.path.join(directory, path)
+        key = os.path.abspath(path)
+        entry = self._files.get(key)
+        if entry is None or self._checked is None \
+                or key not in self._checked:
+            entry = self._check(path, key, entry)
+            if entry is None:
+                contents = File(path).read()
+                return contents[:-1] if cut_last_char else contents, None
+        else:
+            Stats.default().count("includes.hit")
+        if not cut_last_char:
+            return entry[1], entry[3]
+        if entry[2] is None:
+            entry[2] = entry[1][:-1]
+        return entry[2], entry[3]
+
+    def _check(self, path, key, entry):
+        """Validates the entry of a file against its stat, reading the file
+        again when required. Returns None if the file cannot be read."""
+        if self._checked is not None:
+            self._checked.add(key)
+        try:
+            with Stats.default().timer("stat"):
+                stat = os.stat(path)
+        except OSError:
+            stat = None
+        signature = (stat.st_mtime_ns, stat.st_size) \
+            if stat is not None else None
+        if entry is not None:
+            if signature is not None and entry[0] == signature:
+                Stats.default().count("includes.hit")
+                return entry
+            self._files.pop(key)
+        if signature is None:
+            return None
+
+        Stats.default().count("includes.miss")
+        contents = File(path).read()
+        if contents is None:
+            return None
+        if time.time_ns() - signature[0] <= RACY_NS:
+            entry = [None, contents, None, None]
+        else:
+            entry = [signature, contents, None,
+                     (stat.st_mtime, stat.st_size)]
+        self._files.put(key, entry, len(contents))
+        return entry
+
+
+class Render_Cache(object):
+    """Caches the compiled expansion bodies (see Compiler._compile_parsed).
+
+    A body is cached by its content, its schema and the absolute scope it
+    is compiled in, with the reads its compilation made: the schema values
+    it looked up, the functions it called and the files it included. The
+    cached output is only used when every read gives the same result
+    again. A body is therefore only reused when the same scope of the same
+    schema is compiled again, by a later update: only the bodies reading a
+    changed value are compiled again. Identical bodies in different scopes,
+    such as identical loop elements, are each compiled. Bodies that looked
+    up a missing value are not cached, so their warnings are logged every
+    time. The least recently used bodies are evicted beyond max_size bytes.
+
+    Recording the reads only pays off when outputs are compiled again, so
+    the cache is disabled (a max_size of 0) until it is given a size, as
+    Codegen does when watching projects or serving requests.
+    """
+    ENTRY_SIZE = 64
+    MAX_SIZE = 16 * 1024 * 1024
+    _DEFAULT = None
+
+    def __init__(self, max_size=0):
+        self._bodies = Lru_Store("renders", max_size)
+
+    def __repr__(self):
+        return "Render_Cache[bodies='{}', size='{}', max_size='{}']".format(
+            len(self._bodies), self._bodies.size(), self._bodies.max_size)
+
+    @staticmethod
+    def default():
+        """Returns the process wide render cache."""
+        if Render_Cache._DEFAULT is None:
+            Render_Cache._DEFAULT = Render_Cache()
+        return Render_Cache._DEFAULT
+
+    def enabled(self):
+        """Checks whether bodies are cached."""
+        return self._bodies.max_size != 0
+
+    def max_size(self):
+        """Gets the maximum size of the cached bodies."""
+        return self._bodies.max_size
+
+    def set_max_size(self, size):
+        """Sets the maximum size of the cached bodies, None for no limit and
+        0 to disable the cache."""
+        self._bodies.max_size = size
+        if size == 0:
+            self._bodies.clear()
+
+    def size(self):
+        """Gets the size of the cached bodies."""
+        return self._bodies.size()
+
+    def prune(self, ttl):
+        """Drops the bodies not compiled within ttl seconds."""
+        self._bodies.prune(ttl)
+
+    def clear(self):
+        """Empties the cache."""
+        self._bodies.clear()
+
+    def get(self, key):
+        """Gets the (output, reads, tokens) of a body, None if there is
+        none."""
+        return self._bodies.get(key)
+
+    def put(self, key, output, trace, tokens):
+        """Caches the output of a body and the (read, result) pairs of its
+        trace, unless one of the reads cannot be repeated."""
+        for __, result in trace:
+            if result is None:
+                return
+        reads = tuple(dict(trace).items())
+        self._bodies.put(key, (output, reads, tokens), len(output) +
+                         Render_Cache.ENTRY_SIZE * (len(reads) + 1))
+
+    @staticmethod
+    def fingerprint(var, expansion):
+        """Gets what a compilation depends on of the schema value of a token,
+        None if it cannot be cached: a loop on the length of a list (its
+        elements are read by the body), a conditional on the type of a dict,
+        anything else on the value itself. Given no expansion, a list or dict
+        is printed as a whole and cannot be cached."""
+        if var is None:
+            return None
+        if isinstance(var, list):
+            return ("list", len(var)) if expansion else None
+        if isinstance(var, dict):
+            return ("dict",) if expansion else None
+        if isinstance(var, float):
+            return (float, repr(var))
+        return (var.__class__, var)
+
+
+class Template_Cache(object):
+    """Caches parsed templates in memory by content, and optionally on disk
+    by content hash so that they survive between runs.
+
+    The memory cache is limited to max_size bytes of template content,
+    evicting the least recently used templates and their generated code.
+    """
+    VERSION = 4
+    _DEFAULT = None
+
+    def __init__(self, directory=None):
+        self._templates = Lru_Store(
+            "templates", on_evict=lambda content, __: Template_Code.discard(
+                content))
+        self._directory = None
+        self._compiled = False
+        self.set_directory(directory)
+        self._log = logging.getLogger(self.__class__.__name__)
+
+    def __repr__(self):
+        return "Template_Cache[directory='{}', templates='{}']".format(
+            self._directory, len(self._templates))
+
+    @staticmethod
+    def default():
+        """Returns the cache shared by compilers that are not given one."""
+        if Template_Cache._DEFAULT is None:
+            Template_Cache._DEFAULT = Template_Cache()
+        return Template_Cache._DEFAULT
+
+    def directory(self):
+        """Gets the directory used to persist parsed templates."""
+        return self._directory
+
+    def set_directory(self, directory):
+        """Sets the directory used to persist parsed templates."""
+        self._directory = os.path.abspath(directory) if directory else None
+
+    def max_size(self):
+        """Gets the maximum size of the memory cache."""
+        return self._templates.max_size
+
+    def set_max_size(self, size):
+        """Sets the maximum size of the memory cache, None for no limit."""
+        self._templates.max_size = size
+
+    def size(self):
+        """Gets the size of the memory cache."""
+        return self._templates.size()
+
+    def prune(self, ttl):
+        """Evicts the templates not used within ttl seconds."""
+        self._templates.prune(ttl)
+
+    def compiled(self):
+        """Checks whether templates are compiled to Python code."""
+        return self._compiled
+
+    def set_compiled(self, compiled=True):
+        """Sets whether templates are compiled to Python code (see
+        Template_Code) rather than interpreted."""
+        self._compiled = compiled
+
+    def parse(self, content):
+        """Gets the parsed template for the given content."""
+        if not Token.REGEX_OPERATOR.search(content):
+            return Parsed_Template(content)
+
+        parsed = self._templates.get(content)
+        if parsed is None:
+            Stats.default().count("templates.miss")
+            with Stats.default().timer("tokenize"):
+                parsed = Parsed_Template(content, self)
+            self._templates.put(content, parsed, len(content))
+        else:
+            Stats.default().count("templates.hit")
+        return parsed
+
+    def load(self, file):
+        """Gets the parsed template for the contents of the given file."""
+        content = file.read()
+        if not content:
+            return None
+
+        parsed = self._templates.get(content)
+        if parsed is not None:
+            Stats.default().count("templates.hit")
+        elif self._directory:
+            parsed = self._load_disk(content)
+            if parsed is not None:
+                Stats.default().count("templates.disk")
+                self._templates.put(content, parsed, len(content))
+        if parsed is None:
+            parsed = self.parse(content)
+            if self._directory:
+                self._save_disk(content, parsed)
+        return parsed
+
+    def restore(self, parsed):
+        """Adds a template parsed by another process (see Snapshot)."""
+        if parsed.content not in self._templates:
+            self._templates.put(parsed.content, parsed, len(parsed.content))
+
+    def clear(self):
+        """Empties the memory cache."""
+        self._templates.clear()
+
+    def _disk_path(self, content):
+        digest = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        return os.path.join(self._directory, "templates", digest + ".pickle")
+
+    def _load_disk(self, content):
+        path = self._disk_path(content)
+        if not os.path.isfile(path):
+            return None
+        # the version is pickled first, so files of other versions are not
+        # unpickled, any failure to unpickle is a cache miss
+        try:
+            with open(path, "rb") as file:
+                if pickle.load(file) != Template_Cache.VERSION:
+                    return None
+                parsed = pickle.load(file)
+        except Exception as ex:
+            self._log.warning("Could not load cached template: %s %s",
+                              path, ex)
+            return None
+        if not isinstance(parsed, Parsed_Template) \
+                or parsed.content != content:
+            return None
+        return parsed
+
+    def _save_disk(self, content, parsed):
+        path = self._disk_path(content)
+        tmp_path = None
+        try:
+            directory = os.path.dirname(path)
+            os.makedirs(directory, exist_ok=True)
+            # written atomically, as worker processes share the directory
+            fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp",
+                                            dir=directory)
+            with os.fdopen(fd, "wb") as file:
+                pickle.dump(Template_Cache.VERSION, file)
+                pickle.dump(parsed, file)
+            os.replace(tmp_path, path)
+        except (OSError, pickle.PickleError) as ex:
+            self._log.warning("Could not cache template: %s %s", path, ex)
+            if tmp_path is not None:
+                File.discard(tmp_path)
+
+
+class Template_Code(object):
+    """Translates parsed templates into Python generator functions.
+
+    The function of a template yields the same chunks Compiler._interpret
+    does, with its tokens unrolled into straight-line code: values are looked
+    up and loops, selects and conditionals are run directly, functions and
+    includes are resolved by the compiler. A resolved string that contains a
+    token, or could complete one with the text after it, is handed to the
+    interpreter (see Compiler._resume). Loops are compiled as a whole rather
+    than streamed element by element.
+
+    Functions are cached by the sha1 of the template content.
+    """
+    _functions = {}
+
+    @staticmethod
+    def get(parsed):
+        """Gets the function of a parsed template, called with the compiler,
+        the parsed template and a Line_Tracker."""
+        if parsed.code is None:
+            digest = hashlib.sha1(parsed.content.encode("utf-8")).hexdigest()
+            code = Template_Code._functions.get(digest)
+            if code is None:
+                Stats.default().count("code.miss")
+                with Stats.default().timer("tokenize"):
+                    namespace = {"Token": Token}
+                    exec(compile(Template_Code.source(parsed),
+                                 "<template {}>".format(digest[:12]), "exec"),
+                         namespace)
+                code = namespace["render"]
+                Template_Code._functions[digest] = code
+            else:
+                Stats.default().count("code.hit")
+            parsed.code = code
+        return parsed.code
+
+    @staticmethod
+    def clear():
+        """Empties the cache of functions."""
+        Template_Code._functions = {}
+
+    @staticmethod
+    def discard(content):
+        """Removes the function of a template content from the cache."""
+        if Template_Code._functions:
+            Template_Code._functions.pop(
+                hashlib.sha1(content.encode("utf-8")).hexdigest(), None)
+
+    @staticmethod
+    def source(parsed):
+        """Gets the source of the function of a parsed template."""
+        lines = ["def render(c, P, line):",
+                 "    T = P.tokens",
+                 "    push = c._stack.push",
+                 "    pop = c._stack.pop",
+                 "    node = c._stack.node",
+                 "    write = line.write",
+                 "    operator = Token.REGEX_OPERATOR.search",
+                 "    boundary = Token.starts_at_boundary",
+                 "    timed = c._stats.enabled"]
+        content = parsed.content
+        pos = 0
+        for index, token in enumerate(parsed.tokens):
+            if token.start > pos:
+                lines += Template_Code._literal(content[pos:token.start])
+            lines += Template_Code._token(
+                index, token, content[token.end:token.end + 4])
+            pos = token.end
+        if pos < len(content):
+            lines += Template_Code._literal(content[pos:])
+        lines.append("    yield from ()")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _literal(text):
+        return ["    write({0})".format(repr(text)),
+                "    yield {0}".format(repr(text))]
+
+    @staticmethod
+    def _token(index, token, after):
+        lines = ["    # {}".format(".".join([token.operator] + token.path)),
+                 "    c._tokens += 1",
+                 "    t = T[{}]".format(index)]
+        if token.operator not in Compiler.VALUE_OPERATORS:
+            lines.append("    r = c._resolve(t)")
+        elif token.expansion is None:
+            lines += Template_Code._lookup()
+            lines += ["    if found and var is not None:",
+                      "        r = str(var)",
+                      "        pop()",
+                      "    else:",
+                      "        pop()",
+                      "        r = c._resolve_value(t)"]
+        else:
+            lines += Template_Code._lookup()
+            lines += ["    if not found or var is None:",
+                      "        pop()",
+                      "        r = c._resolve_value(t)",
+                      "    elif isinstance(var, list):",
+                      "        parts = []",
+                      "        for i in t.resolve_indices(var):",
+                      "            push(i)",
+                      "            parts.append(c._compile_parsed(t.body))",
+                      "            pop()",
+                      "        r = ''.join(parts)",
+                      "        pop()"]
+            if token.select is None:
+                lines.append("    else:")
+            else:
+                select = repr(token.select)
+                lines += [
+                    "    elif isinstance(var, bool) \\",
+                    "            and var == bool({0}) \\".format(select),
+                    "            or isinstance(var, int) \\",
+                    "            and var == int({0}) \\".format(select),
+                    "            or isinstance(var, float) \\",
+                    "            and var == float({0}) \\".format(select),
+                    "            or isinstance(var, str) \\",
+                    "            and var == {0}:".format(select)]
+            lines += ["        r = c._compile_parsed(t.body)",
+                      "        pop()"]
+            if token.select is not None:
+                lines += ["    else:",
+                          "        r = ''",
+                          "        pop()"]
+        if token.expansion:
+            lines += ["    indent = {} - line.line_length()".format(
+                          token.indent),
+                      "    if indent != 0:",
+                      "        r = c._indent(r, t, indent)"]
+        lines += ["    if r:",
+                  "        if operator(r) or boundary(r, {}):".format(
+                      repr(after)),
+                  "            if not (yield from c._resume(P, {}, r, line)):"
+                  .format(index),
+                  "                return",
+                  "        else:",
+                  "            write(r)",
+                  "            yield r"]
+        return lines
+
+    @staticmethod
+    def _lookup():
+        """Pushes the token and looks up its value, timed as the resolve
+        phase when stats are collected (see Compiler._lookup)."""
+        return ["    if timed:",
+                "        found, var = c._lookup(t)",
+                "    else:",
+                "        push(t)",
+                "        found, var = node()"]
+
+
+class Line_Tracker(object):
+    """Tracks the length of the current line of the compiled output."""
+    def __init__(self):
+        self._line_length = 0
+        self._has_newline = False
+
+    def write(self, chunk):
+        """Advances past a chunk of output."""
+        newline = chunk.rfind("\n")
+        if newline == -1:
+            self._line_length += len(chunk)
+        else:
+            self._line_length = len(chunk) - newline - 1
+            self._has_newline = True
+
+    def line_length(self):
+        """Gets the length of the last line, see Compiler.curr_line_length."""
+        return self._line_length if self._has_newline else 0
+
+
 class Compiler(object):
     """Builds a template compiler from a given schema."""
+    VALUE_OPERATORS = ("$$", "!!", "^^")
 
-    def __init__(self, schema):
+    def __init__(self, schema, templates=None, context=None):
         if not isinstance(schema, Schema):
             raise ValueError(
                 "Compiler() - Expected Schema: ", schema)
 
         self.log = logging.getLogger(self.__class__.__name__)
         self._stack = Schema_Stack(schema)
+        self._templates = templates if templates is not None \
+            else Template_Cache.default()
+        self._dependencies = set()
+        self._signatures = {}
+        self._stats = Stats.default()
+        self._tokens = 0
+        self._schema = schema
+        self._context = context if context is not None \
+            else Compile_Context()
+        self._renders = Render_Cache.default()
+        self._trace = []
+        self._depth = 0
+        self._includes = {}
+        self._calls = {}
+        self._depend(schema.path(), schema.signature())
         schema.update()
 
     def compile(self, template):
         """Compiles a template using the compiler schema."""
+        return "".join(self.compile_iter(template))
+
+    def compile_iter(self, template):
+        """Compiles a template using the compiler schema, returns an iterator
+        over the chunks of the output as they are resolved."""
         if isinstance(template, File):
-            tmp = template.read()
+            self._depend(template.path(), template.signature())
+            parsed = self._templates.load(template)
         elif isinstance(template, str):
-            tmp = template
+            parsed = self._templates.parse(template) if template else None
         else:
             raise TypeError("Expected str or File: ", template)
 
-        if not tmp:
+        if not parsed:
             raise ValueError("Could not compile: Empty template.")
 
-        out = ""
-        token = Token.find(tmp)
-        while token is not None:
-            out += tmp[:token.start]
-            resolved = self._resolve(token)
+        return self._render(parsed)
+
+    def compile_to(self, template, stream):
+        """Compiles a template using the compiler schema, writing the output
+        to the stream chunk by chunk."""
+        for chunk in self.compile_iter(template):
+            stream.write(chunk)
+
+    def dependencies(self):
+        """Gets the paths of the files read by this compiler: the schema and
+        every template and include compiled so far."""
+        return sorted(self._dependencies)
+
+    def signatures(self):
+        """Gets the dependencies with the signatures of the files taken
+        before they were read (see Dependency_Graph.record)."""
+        return {path: self._signatures[path] for path in self._dependencies}
+
+    def tokens(self):
+        """Gets the number of tokens resolved so far."""
+        return self._tokens
+
+    def reads(self):
+        """Gets what the outputs compiled so far depend on besides their
+        template and schema: the "includes" as [operator, path, sha1] and
+        the "calls" of functions that do not only depend on their argument
+        (see FunctionResolver.PURE) as [path, argument, value]."""
+        return {
+            "includes": [[op, path, digest] for (op, path), digest
+                         in self._includes.items()],
+            "calls": [[list(path), arg, value] for (path, arg), value
+                      in self._calls.items()]
+        }
+
+    def _compile_parsed(self, parsed):
+        """Compiles an expansion body in the current scope, taken from the
+        render cache when the reads of an earlier compilation give the same
+        results (see Render_Cache)."""
+        if not parsed.tokens or not self._renders.enabled():
+            return "".join(self._render(parsed))
+
+        key = (parsed.content, self._context.directory, self._schema.path(),
+               tuple(self._stack.curr_scope()))
+        entry = self._renders.get(key)
+        if entry is not None and self._repeat(entry[1]):
+            self._stats.count("renders.hit")
+            if self._depth:
+                self._trace.extend(entry[1])
+            self._tokens += entry[2]
+            return entry[0]
+        self._stats.count("renders.miss")
+
+        # the reads of nested bodies are part of the trace of this one
+        trace = self._trace
+        start = len(trace)
+        tokens = self._tokens
+        self._depth += 1
+        self._stack.trace = trace
+        output = "".join(self._render(parsed))
+        self._depth -= 1
+        self._renders.put(key, output, trace[start:], self._tokens - tokens)
+        if not self._depth:
+            self._stack.trace = None
+            del trace[:]
+        return output
+
+    def _repeat(self, reads):
+        """Checks whether the reads of a cached body give the same results,
+        adding the files it includes to the dependencies if they do."""
+        includes = []
+        calls = []
+        for read, result in reads:
+            op = read[0] if read else None
+            if op == "%%":
+                try:
+                    func = self._context.resolve(list(read[1]))
+                except ValueError:
+                    return False
+                if (func if isinstance(func, str) else
+                        self._call(read[1], func, read[2])) != result:
+                    return False
+                if not isinstance(func, str):
+                    calls.append((read[1], read[2], result))
+            elif op == "@@" or op == "@@!":
+                text, signature = Include_Cache.default().read_signed(
+                    read[1], op == "@@!", self._context.directory)
+                if text is None or (hash(text), len(text)) != result:
+                    return False
+                includes.append((op, read[1], text, signature))
+            else:
+                found, var = self._schema.node(read)
+                if not found \
+                        or Render_Cache.fingerprint(var, True) != result:
+                    return False
+        for op, path, text, signature in includes:
+            self._depend(path, signature)
+            self._record_include(op, path, text)
+        for call in calls:
+            self._record_call(*call)
+        return True
+
+    def _depend(self, path, signature):
+        """Adds a file to the dependencies with the signature it was read
+        with, None if it was read with different signatures."""
+        if path in self._dependencies \
+                and self._signatures[path] != signature:
+            signature = None
+        self._signatures[path] = signature
+        self._dependencies.add(path)
+
+    def _record_include(self, op, path, text):
+        """Records the sha1 of an included file, see reads."""
+        if (op, path) not in self._includes:
+            self._includes[(op, path)] = hashlib.sha1(
+                text.encode("utf-8")).hexdigest() if text is not None \
+                else None
+
+    def _record_call(self, path, arg, value):
+        """Records the value of a function call, see reads."""
+        if path[0] not in FunctionResolver.PURE:
+            self._calls[(tuple(path), arg)] = value
+
+    def _render(self, parsed):
+        """Yields the compiled chunks of a parsed template, running its
+        generated code when the template cache compiles templates (see
+        Template_Code) and interpreting it otherwise."""
+        if self._templates.compiled():
+            return Template_Code.get(parsed)(self, parsed, Line_Tracker())
+        return self._interpret([[parsed, 0, 0, None]], Line_Tracker(), 0)
+
+    def _resume(self, parsed, index, resolved, line):
+        """Interprets the resolved string of the index-th token of a compiled
+        template, as it may contain tokens or complete one with the text after
+        it. Returns True when the rest of the template is left to the compiled
+        code, False when it had to be merged and interpreted too."""
+        frames = [[parsed, index + 1, parsed.tokens[index].end, None],
+                  [self._templates.parse(resolved), 0, 0, None]]
+        yield from self._interpret(frames, line, 1)
+        if frames[0][0] is parsed:
+            return True
+        yield from self._interpret(frames, line, 0)
+        return False
+
+    def _interpret(self, frames, line, base):
+        """Walks the frames, yielding literals and resolved tokens, until only
+        base frames are left.
+
+        Resolved tokens may themselves contain tokens (includes, schema values
+        referencing other values), so they are pushed as frames on top of the
+        remaining template and compiled before it. The concatenation of all
+        the frames is always the text still left to compile; a frame is merged
+        with the one below it whenever a token could straddle the two.
+
+        A loop is not resolved up front: its frame holds an iterator over the
+        compiled elements (see _iterate) and pulls the next one in once its
+        text runs out, so only one element is held in memory at a time.
+        """
+        while len(frames) > base:
+            frame = frames[-1]
+            parsed, index, pos, pieces = frame
+            text = parsed.content
+            token = parsed.tokens[index] \
+                if index < len(parsed.tokens) else None
+
+            if pieces is not None and (token is None or not token.contained):
+                keep = token.start if token is not None \
+                    else max(pos, len(text) - 3)
+                if keep > pos:
+                    line.write(text[pos:keep])
+                    yield text[pos:keep]
+                if not self._pull(frame, keep):
+                    frame[2] = keep
+                continue
+
+            if len(frames) > 1:
+                if token is None:
+                    contained = not Token.starts_at_boundary(
+                        text[max(pos, len(text) - 3):],
+                        self._lookahead(frames, 4))
+                else:
+                    contained = token.contained
+                if not contained:
+                    frames.pop()
+                    below = frames[-1]
+                    merged = text[pos:] + below[0].content[below[2]:]
+                    with self._stats.timer("tokenize"):
+                        merged = Parsed_Template(merged, self._templates)
+                    below[:] = [merged, 0, 0, below[3]]
+                    continue
+
+            if token is None:
+                if pos < len(text):
+                    line.write(text[pos:])
+                    yield text[pos:]
+                frames.pop()
+                continue
+
+            if token.start > pos:
+                line.write(text[pos:token.start])
+                yield text[pos:token.start]
+            frame[1] = index + 1
+            frame[2] = token.end
+            self._tokens += 1
+            resolved = self._resolve(token, True)
+
+            if token.operator in Compiler.VALUE_OPERATORS \
+                    and not isinstance(resolved, str):
+                indent = token.indent - line.line_length()
+                frames.append([Parsed_Template(""), 0, 0,
+                               self._iterate(token, resolved, indent)])
+                continue
 
             if token.expansion:
-                indent = token.indent - Compiler.curr_line_length(out)
+                indent = token.indent - line.line_length()
                 if indent != 0:
-                    ind = "\n" + " " * abs(indent)
+                    resolved = self._indent(resolved, token, indent)
+
+            if resolved:
+                frames.append([self._templates.parse(resolved), 0, 0, None])
+
+    def _indent(self, resolved, token, indent):
+        """Fixes the indentation of the resolved expansion of a token, indent
+        being the token indent minus the length of the current line."""
+        with self._stats.timer("indent"):
+            ind = "\n" + " " * abs(indent)
+            if indent > 0:
+                return resolved.replace(ind, "\n")[token.indent:]
+            return resolved.replace("\n", ind)
+
+    def _pull(self, frame, pos):
+        """Appends the next element of the frame's loop to the text of the
+        frame from pos on. Returns False once the loop is done."""
+        piece = next(frame[3], None)
+        if piece is None:
+            frame[3] = None
+            return False
+        frame[:] = [self._templates.parse(frame[0].content[pos:] + piece),
+                    0, 0, frame[3]]
+        return True
+
+    def _iterate(self, token, indices, indent):
+        """Yields the compiled expansion of a loop token element by element,
+        with the indentation fixed like _indent does for resolved strings.
+
+        The fix of a positive indent removes '\n' followed by indent spaces,
+        so a trailing '\n' with fewer spaces is carried over to the next
+        element, where it may complete the pattern.
+        """
+        ind = "\n" + " " * abs(indent)
+        skip = token.indent if indent > 0 else 0
+        carry = ""
+        for index in indices:
+            self._stack.push(token)
+            self._stack.push(index)
+            piece = self._compile_parsed(token.body)
+            self._stack.pop()
+            self._stack.pop()
+
+            if indent != 0:
+                with self._stats.timer("indent"):
                     if indent > 0:
-                        resolved = resolved.replace(ind, "\n")[token.indent:]
+                        piece = carry + piece
+                        carry = ""
+                        newline = piece.rfind("\n")
+                        if newline != -1 and len(piece) - newline < len(ind) \
+                                and not piece[newline + 1:].strip(" "):
+                            carry = piece[newline:]
+                            piece = piece[:newline]
+                        piece = piece.replace(ind, "\n")
+                        if skip:
+                            cut = min(skip, len(piece))
+                            piece = piece[cut:]
+                            skip -= cut
                     else:
-                        resolved = resolved.replace("\n", ind)
-
-            tmp = resolved + tmp[token.end:]
-            token = Token.find(tmp)
-
-        return out + tmp
+                        piece = piece.replace("\n", ind)
+            if piece:
+                yield piece
+
+        carry = carry[skip:]
+        if carry:
+            yield carry
+
+    def _lookahead(self, frames, length):
+        """Gets the next characters of the frames below the top frame, pulling
+        in loop elements where a frame runs short."""
+        chars = ""
+        for frame in reversed(frames[:-1]):
+            while frame[3] is not None \
+                    and len(frame[0].content) - frame[2] < length:
+                self._pull(frame, frame[2])
+            parsed, __, pos, __ = frame
+            chars += parsed.content[pos:pos + length - len(chars)]
+            if len(chars) >= length:
+                break
+        return chars
 
     @staticmethod
     def curr_line_length(string):
-        """Gets the length of the last line."""
-        indent = 0
-        for c in reversed(string):
-            if c == '\n':
-                return indent
-            indent += 1
-        return 0
-
-    def _resolve(self, token):
+        """Gets the length of the last line, 0 without a newline."""
+        newline = string.rfind("\n")
+        return len(string) - newline - 1 if newline != -1 else 0
+
+    def _lookup(self, token):
+        """Pushes a value token and looks up its value, timed as the resolve
+        phase (see Template_Code)."""
+        with self._stats.timer("resolve"):
+            self._stack.push(token)
+            return self._stack.node()
+
+    def _resolve(self, token, lazy=False):
         op = token.operator
 
         if op == "$$" or op == "!!" or op == "^^":
-            result = self._resolve_value(token)
+            if self._stats.enabled:
+                with self._stats.timer("resolve"):
+                    result = self._resolve_value(token, lazy)
+            else:
+                result = self._resolve_value(token, lazy)
         elif op == "%%":
-            func = FunctionResolver.resolve(token.path)
+            func = self._context.resolve(token.path)
+            arg = None
             if func:
                 if isinstance(func, str):
                     result = func
                 elif callable(func):
                     if token.expansion:
-                        result = func(self.compile(token.expansion))
-                    else:
-                        result = func()
+                        arg = self._compile_parsed(token.body)
+                    result = self._call(token.path, func, arg)
+                    self._record_call(token.path, arg, result)
                 else:
                     raise ValueError("Resolved is not a function or a string "
                                      "({} => {}).".format(".".join(token.path),
                                                           func))
+                if self._stack.trace is not None:
+                    self._stack.trace.append(
+                        (("%%", tuple(token.path), arg), result))
 
         elif op == "@@" or op == "@@!":
-            result = token.resolve_template(op == "@@!")
+            result, signature = token.resolve_template(
+                op == "@@!", self._context.directory)
+            self._depend(token.template_path(), signature)
+            self._record_include(op, token.template_path(), result)
+            if self._stack.trace is not None:
+                self._stack.trace.append(
+                    ((op, token.template_path()), (hash(result), len(result))
+                     if result is not None else None))
 
         return result or ""
 
-    def _resolve_value(self, token):
+    def _call(self, path, func, arg=None):
+        """Calls a function with the compiled expansion arg, or without an
+        argument (see Compile_Context.call) when there is none."""
+        with self._stats.timer("function"):
+            if arg is not None:
+                return func(arg)
+            return self._context.call(path, func)
+
+    def _resolve_value(self, token, lazy=False):
+        """Resolves a value token. Given lazy, a loop is not compiled but the
+        indices of the elements to compile are returned."""
         if not isinstance(token, Token):
             raise TypeError("Expected Token: ", token)
 
@@ -645,10 +3904,12 @@ class Compiler(object):
         var = self._stack.value()
         if var is not None:
             if token.expansion is not None:
-                if isinstance(var, list):
+                if isinstance(var, list) and lazy and token.expansion:
+                    resolved = token.resolve_indices(var)
+                elif isinstance(var, list):
                     for index in token.resolve_indices(var):
                         self._stack.push(index)
-                        resolved += self.compile(token.expansion)
+                        resolved += self._compile_parsed(token.body)
                         self._stack.pop()
                 else:
                     select = token.select
@@ -658,7 +3919,7 @@ class Compiler(object):
                         or isinstance(var, float) and var == float(select) \
                         or isinstance(var, str) and var == select
                     if do_compile:
-                        resolved = self.compile(token.expansion)
+                        resolved = self._compile_parsed(token.body)
             else:
                 resolved = str(var)
         else:
@@ -670,24 +3931,345 @@ class Compiler(object):
         return resolved
 
 
+class Poll_Watcher(object):
+    """Waits for changes by polling, every wait results in a full update."""
+    def __init__(self, interval=2):
+        self._interval = interval
+
+    def __repr__(self):
+        return "Poll_Watcher[interval='{}']".format(self._interval)
+
+    def watch(self, directories):
+        """Polling checks every file on update, directories are ignored."""
+
+    def wait(self):
+        """Sleeps for the interval, returns None as the changes are unknown."""
+        time.sleep(self._interval)
+        return None
+
+    def close(self):
+        """Nothing to release."""
+
+
+class Inotify_Watcher(object):
+    """Waits for changes in directories using Linux inotify."""
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO \
+        | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, debounce=0.1):
+        self._log = logging.getLogger(self.__class__.__name__)
+        self._debounce = debounce
+        self._watches = {}
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"),
+                                 use_errno=True)
+        self._fd = self._libc.inotify_init1(
+            Inotify_Watcher.IN_NONBLOCK | Inotify_Watcher.IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def __repr__(self):
+        return "Inotify_Watcher[directories='{}']".format(len(self._watches))
+
+    @staticmethod
+    def available():
+        """Checks whether inotify can be used on this platform."""
+        if not sys.platform.startswith("linux"):
+            return False
+        name = ctypes.util.find_library("c")
+        return name is not None \
+            and hasattr(ctypes.CDLL(name), "inotify_init1")
+
+    def watch(self, directories):
+        """Watches exactly the given directories."""
+        watched = {path: wd for wd, path in self._watches.items()}
+        for path in set(watched) - set(directories):
+            self._libc.inotify_rm_watch(self._fd, watched[path])
+            del self._watches[watched[path]]
+        for path in set(directories) - set(watched):
+            wd = self._libc.inotify_add_watch(
+                self._fd, os.fsencode(path), Inotify_Watcher.MASK)
+            if wd < 0:
+                self._log.warning("Could not watch directory: %s (%s)", path,
+                                  os.strerror(ctypes.get_errno()))
+            else:
+                self._watches[wd] = path
+
+    def wait(self):
+        """Blocks until a file changes, then collects changes until none
+        arrive for the debounce interval. Returns the changed paths, None
+        if events were lost as the queue overflowed."""
+        changed = set()
+        overflow = False
+        select.select([self._fd], [], [])
+        while select.select([self._fd], [], [], self._debounce)[0]:
+            if not self._read(changed):
+                overflow = True
+        if overflow:
+            self._log.warning("Inotify queue overflowed, updating all")
+            return None
+        return changed
+
+    def close(self):
+        """Releases the inotify file descriptor."""
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+            self._watches = {}
+
+    def _read(self, changed):
+        """Adds the changed paths read, returns False if the queue
+        overflowed."""
+        try:
+            buf = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return True
+        offset = 0
+        while offset < len(buf):
+            wd, mask, __, length = Inotify_Watcher.EVENT.unpack_from(
+                buf, offset)
+            offset += Inotify_Watcher.EVENT.size
+            name = buf[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & Inotify_Watcher.IN_Q_OVERFLOW:
+                return False
+            if mask & Inotify_Watcher.IN_IGNORED:
+                self._watches.pop(wd, None)
+            elif wd in self._watches and name:
+                changed.add(os.path.join(self._watches[wd],
+                                         os.fsdecode(name)))
+        return True
+
+
+class Codegen_Server(object):
+    """Serves requests on a Unix domain socket, keeping projects, schemas,
+    parsed templates and dependency graphs in memory between requests.
+
+    A request is a json line holding the "command" (see handle) and the
+    "cwd" of the client. The response is a json line holding the "status",
+    "ok" or "error", and the log "records" of the request. Connections are
+    served concurrently by asyncio with at most limit requests pending.
+    Requests run one after another, so the log records of a response are
+    those of its request; with worker processes (see Codegen.set_jobs) the
+    jobs of a request run in parallel. Paths are relative to the "cwd" of
+    the request, the server does not change its working directory.
+    """
+    LIMIT = 1 << 26
+
+    def __init__(self, codegen, path, limit=16):
+        self._codegen = codegen
+        self._path = path
+        self._limit = limit
+        self._directory = os.getcwd()
+        self._projects = {}
+        self._stopping = False
+        self._log = logging.getLogger(self.__class__.__name__)
+
+    def __repr__(self):
+        return "Codegen_Server[path='{}']".format(self._path)
+
+    def run(self):
+        """Serves until a shutdown request, SIGTERM or an interrupt."""
+        if os.path.exists(self._path):
+            if not Codegen_Server._is_socket(self._path):
+                raise ValueError("Not a socket, not serving on: {}"
+                                 .format(self._path))
+            try:
+                Codegen_Server.send(self._path, {"command": "ping"})
+            except OSError:
+                os.unlink(self._path)
+            else:
+                raise ValueError("A server is already listening on: {}"
+                                 .format(self._path))
+        try:
+            asyncio.run(self._serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if Codegen_Server._is_socket(self._path):
+                os.unlink(self._path)
+
+    @staticmethod
+    def _is_socket(path):
+        """Checks whether the path exists and is a socket."""
+        try:
+            return stat.S_ISSOCK(os.stat(path).st_mode)
+        except OSError:
+            return False
+
+    @staticmethod
+    def send(path, request):
+        """Sends a request to the server listening on path and returns the
+        response, an OSError is raised when it cannot be reached."""
+        request = dict(request, cwd=os.getcwd())
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(path)
+            client.sendall((json.dumps(request) + "\n").encode("utf-8"))
+            with client.makefile("r", encoding="utf-8") as file:
+                line = file.readline()
+        if not line:
+            raise ConnectionError("The server closed the connection.")
+        return json.loads(line)
+
+    def handle(self, request):
+        """Handles a request, returning the response. The commands are:
+
+        "project": updates the project at "path", only the output items
+            depending on the "changed" paths when given. Responds with the
+            outputs "written" and "unchanged" and the number of "failures".
+        "compile": compiles the "templates" with the "schemas", responds
+            with the "outputs".
+        "batch": compiles the manifest "lines" (see Codegen.process_batch),
+            responds with the job "statuses".
+        "stats": responds with the "stats" (see Stats.json).
+        "ping": responds with nothing.
+        "shutdown": stops the server once the response is sent.
+        """
+        directory = request.get("cwd") or self._directory
+        command = request.get("command")
+        if command == "project":
+            return self._update_project(request["path"],
+                                        request.get("changed"), directory)
+        if command == "compile":
+            return self._compile(request.get("schemas") or [],
+                                 request.get("templates") or [], directory)
+        if command == "batch":
+            return {"statuses": list(self._codegen.batch_statuses(
+                request.get("lines") or [],
+                self._codegen.registry(directory), directory))}
+        if command == "stats":
+            return {"stats": json.loads(Stats.default().json())}
+        if command == "ping":
+            return {}
+        if command == "shutdown":
+            self._stopping = True
+            return {}
+        raise ValueError("Unknown command: {}".format(command))
+
+    def _update_project(self, path, changed, directory):
+        path = os.path.normpath(os.path.join(directory, path))
+        project = self._projects.get(path)
+        if project is None:
+            project = Project(path,
+                              self._codegen.registry(os.path.dirname(path)),
+                              self._codegen.executor())
+            project.use_snapshot(self._codegen.snapshots())
+            self._projects[path] = project
+            changed = None
+        if changed is not None:
+            changed = set(os.path.normpath(os.path.join(directory, path))
+                          for path in changed)
+        project.update(changed)
+        written, unchanged = project.written()
+        return {"written": written, "unchanged": unchanged,
+                "failures": project.failures()}
+
+    def _compile(self, schemas, templates, directory):
+        context = Compile_Context(directory,
+                                  started=FunctionResolver.begin_run())
+        registry = self._codegen.registry(directory)
+        registry.begin_run()
+        outputs = []
+        for schema in schemas:
+            compiler = Compiler(registry.get(schema), context=context)
+            for template in templates:
+                outputs.append(compiler.compile(File(template, directory)))
+        return {"outputs": outputs}
+
+    def _respond(self, line):
+        """Handles a request line in the worker thread, capturing the log
+        records of the request."""
+        root = logging.getLogger()
+        handler = Record_Handler()
+        root.addHandler(handler)
+        try:
+            response = self.handle(json.loads(line.decode("utf-8")))
+            response["status"] = "ok"
+        except (ValueError, KeyError, TypeError, OSError) as ex:
+            self._log.error("Request failed: %s", ex)
+            response = {"status": "error", "error": str(ex)}
+        finally:
+            root.removeHandler(handler)
+            self._codegen.prune()
+        response["records"] = [record.__dict__ for record in handler.records]
+        return (json.dumps(response, default=str) + "\n").encode("utf-8")
+
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+        pending = asyncio.Semaphore(self._limit)
+        with concurrent.futures.ThreadPoolExecutor(1) as thread:
+            async def connection(reader, writer):
+                try:
+                    while True:
+                        line = await reader.readline()
+                        if not line:
+                            break
+                        async with pending:
+                            response = await loop.run_in_executor(
+                                thread, self._respond, line)
+                        writer.write(response)
+                        await writer.drain()
+                        if self._stopping:
+                            stop.set()
+                            break
+                except (ConnectionError, ValueError) as ex:
+                    self._log.warning("Connection closed: %s", ex)
+                except asyncio.CancelledError:
+                    pass
+                finally:
+                    writer.close()
+
+            server = await asyncio.start_unix_server(
+                connection, self._path, limit=Codegen_Server.LIMIT)
+            self._log.info("Serving on %s", self._path)
+            async with server:
+                await stop.wait()
+
+
 class Codegen(object):
     """Performs the main logic."""
     def __init__(self):
         self._schemas = {}
         self._templates = {}
         self._projects = {}
+        self._batch = None
+        self._changed = None
+        self._serve = None
+        self._client = None
+        self._shutdown = False
+        self._failed = 0
+        self._registry = Schema_Registry()
+        self._registries = {}
+        self._executor = None
+        self._jobs = 1
+        self._stats = None
+        self._profile = None
 
         self._do_print = False
         self._do_watch = False
+        self._watch_backend = None
 
-        self._watch_interval = 15
-        self._recent_interval = 2
-        self._recent_ttl = 300
-        self._watch_interval_counter = 0
+        self._cache_ttl = 300
+        self._snapshot = False
+        self._render_size = None
+        self._render_budget = Render_Cache.MAX_SIZE
 
     def add_schema(self, schema):
         """Adds a schema to the internal list."""
-        self._schemas[schema] = Schema(schema)
+        self._schemas[schema] = None
 
     def add_template(self, template):
         """Adds a template to the internal list."""
@@ -695,40 +4277,446 @@ class Codegen(object):
 
     def add_project(self, project):
         """Adds a template to the internal list."""
-        self._projects[project] = Project(project)
+        self._projects[project] = Project(project, self.registry(
+            os.path.dirname(os.path.abspath(project))))
+
+    def add_batch(self, path):
+        """Sets the batch manifest to compile, a file or '-' for stdin (see
+        process_batch)."""
+        self._batch = path
+
+    def add_changed(self, paths):
+        """Adds paths that changed since the last update, sent with the
+        projects to the server so only the output items depending on them
+        are updated (see connect)."""
+        self._changed = (self._changed or []) + [
+            os.path.abspath(path) for path in paths]
+
+    def serve(self, path):
+        """Serve requests on the Unix domain socket path rather than
+        processing (see Codegen_Server)."""
+        self._serve = path
+
+    def connect(self, path, shutdown=False):
+        """Forward the projects, schemas and templates or batch to the server
+        listening on the Unix domain socket path rather than processing,
+        or ask it to shut down."""
+        self._client = path
+        self._shutdown = shutdown
+
+    def registry(self, directory=None):
+        """Gets the schema registry, or given a directory the registry for
+        paths relative to it, sharing the settings of the schema registry."""
+        if directory is None:
+            return self._registry
+        registry = self._registries.get(directory)
+        if registry is None:
+            registry = Schema_Registry(self._registry.lazy_size,
+                                       self._registry.max_size(), directory)
+            self._registries[directory] = registry
+        return registry
+
+    def _all_registries(self):
+        return [self._registry] + list(self._registries.values())
+
+    def executor(self):
+        """Gets the executor of the worker processes, None without."""
+        return self._executor
+
+    def set_jobs(self, jobs):
+        """Sets the number of worker processes used to compile."""
+        self._jobs = max(1, jobs)
+
+    def cache_dir(self, directory):
+        """Persist parsed templates in the given directory."""
+        Template_Cache.default().set_directory(directory)
+
+    def compile_templates(self):
+        """Compile templates to Python code (see Template_Code) rather than
+        interpreting them."""
+        Template_Cache.default().set_compiled()
+
+    def memory_budget(self, size):
+        """Limits the memory caches to about size bytes: three eighths for
+        parsed templates, an eighth for compiled bodies and a quarter each
+        for schemas and included files."""
+        Template_Cache.default().set_max_size(size * 3 // 8)
+        self._render_budget = size // 8
+        Include_Cache.default().set_max_size(size // 4)
+        for registry in self._all_registries():
+            registry.set_max_size(size // 4)
+
+    def cache_ttl(self, seconds):
+        """Evicts cached templates, bodies, schemas and included files not
+        used for seconds, checked after every watch update or server
+        request."""
+        self._cache_ttl = seconds
+
+    def limits(self):
+        """Gets the cache limits, to be applied in the worker processes."""
+        return {
+            "templates": Template_Cache.default().max_size(),
+            "includes": Include_Cache.default().max_size(),
+            "renders": Render_Cache.default().max_size(),
+            "schemas": self._registry.max_size(),
+            "ttl": self._cache_ttl
+        }
 
-    def watch_project(self):
-        """Print compile results to stdout."""
+    def prune(self):
+        """Evicts the cache entries not used within the ttl and reports the
+        memory used by the caches to the stats."""
+        Template_Cache.default().prune(self._cache_ttl)
+        Include_Cache.default().prune(self._cache_ttl)
+        Render_Cache.default().prune(self._cache_ttl)
+        Output_Cache.default().prune()
+        schemas = 0
+        for registry in self._all_registries():
+            registry.prune(self._cache_ttl)
+            schemas += registry.size()
+        stats = Stats.default()
+        stats.gauge("memory.templates", Template_Cache.default().size())
+        stats.gauge("memory.includes", Include_Cache.default().size())
+        stats.gauge("memory.renders", Render_Cache.default().size())
+        stats.gauge("memory.schemas", schemas)
+
+    def include_cache(self, size):
+        """Limits the cached contents of included files to size bytes."""
+        Include_Cache.default().set_max_size(size)
+
+    def render_cache(self, size):
+        """Limits the compiled bodies kept by the render cache to size bytes,
+        0 disables it. By default it is only enabled when watching projects
+        or serving requests."""
+        self._render_size = size
+
+    def output_cache(self, directory=None):
+        """Restore the outputs of projects from the output cache in the
+        directory, the user's cache by default, rather than compiling them
+        (see Output_Cache)."""
+        Output_Cache.default().set_directory(
+            directory or Output_Cache.default_directory())
+
+    def output_cache_size(self, size):
+        """Limits the output cache to size bytes on disk."""
+        Output_Cache.default().max_size = size
+
+    def snapshot(self, enabled=True):
+        """Keep the parsed schemas and templates of the projects in a
+        snapshot, loaded by the next process (see Snapshot)."""
+        self._snapshot = enabled
+
+    def snapshots(self):
+        """Checks whether projects keep a snapshot."""
+        return self._snapshot
+
+    def lazy_schemas(self, size=0):
+        """Load schemas of at least size bytes as a memory-mapped
+        Lazy_Schema."""
+        for registry in self._all_registries():
+            registry.lazy_size = size
+
+    def watch_project(self, backend=None):
+        """Keep updating the projects when their files change, backend is
+        'inotify', 'poll' or None for the best available."""
         self._do_watch = True
+        self._watch_backend = backend
 
     def print_to_stdout(self):
         """Print compile results to stdout."""
         self._do_print = True
 
+    def collect_stats(self, output="table"):
+        """Collect timings and counters, printed to stderr as a 'table' or
+        as 'json' when done."""
+        if output not in ("table", "json"):
+            raise ValueError("Unknown stats output: {}".format(output))
+        self._stats = output
+        Stats.default().enable()
+
+    def profile(self, path):
+        """Profile this process with cProfile, dumping the result to path.
+        Worker processes (see set_jobs) are not profiled."""
+        self._profile = path
+
     def start(self):
-        """Starts processing."""
-        if self._projects:
-            while True:
-                for project in self._projects.values():
-                    project.update()
-                if not self._do_watch:
-                    break
-                try:
-                    time.sleep(2)
-                except KeyboardInterrupt:
-                    break
+        """Starts processing, returns the exit status: 1 if a batch job,
+        forwarded request or forwarded output item failed, 0 otherwise."""
+        if self._client is not None:
+            self._forward()
+            return 1 if self._failed else 0
+        Render_Cache.default().set_max_size(self._render_cache_size())
+        if self._jobs > 1:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                self._jobs, initializer=Compile_Job.init_worker,
+                initargs=(logging.getLogger().level,
+                          Template_Cache.default().directory(),
+                          Stats.default().enabled,
+                          self._registry.lazy_size,
+                          Template_Cache.default().compiled(),
+                          self.limits()))
+            for project in self._projects.values():
+                project.set_executor(self._executor)
+        for project in self._projects.values():
+            project.use_snapshot(self._snapshot)
+        profiler = cProfile.Profile() if self._profile else None
+        try:
+            if profiler is not None:
+                profiler.enable()
+            self._start()
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(self._profile)
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+            if self._stats is not None:
+                self.prune()
+            else:
+                Output_Cache.default().prune()
+            if self._stats == "json":
+                print(Stats.default().json(), file=sys.stderr)
+            elif self._stats is not None:
+                print(Stats.default().table(), file=sys.stderr)
+        return 1 if self._failed else 0
+
+    def _render_cache_size(self):
+        if self._render_size is not None:
+            return self._render_size
+        if self._do_watch or self._serve is not None:
+            return self._render_budget
+        return 0
+
+    def _start(self):
+        if self._serve is not None:
+            Codegen_Server(self, self._serve).run()
+        elif self._batch is not None:
+            if self._batch == "-":
+                self.process_batch(sys.stdin)
+            else:
+                with open(self._batch, "r") as file:
+                    self.process_batch(file)
+        elif self._projects:
+            watcher = None
+            changed = None
+            try:
+                while True:
+                    self._update_projects(changed)
+                    if not self._do_watch:
+                        break
+                    self.prune()
+                    if watcher is None:
+                        watcher = self._create_watcher()
+                    watcher.watch(set().union(*(
+                        project.watch_dirs()
+                        for project in self._projects.values())))
+                    try:
+                        changed = watcher.wait()
+                    except KeyboardInterrupt:
+                        break
+            finally:
+                if watcher is not None:
+                    watcher.close()
         else:
-            self.process(self._schemas.values(), self._templates.values())
+            self.process([self._registry.get(schema)
+                          for schema in self._schemas],
+                         self._templates.values())
+
+    def _update_projects(self, changed=None):
+        """Updates the projects, several projects at the same time."""
+        projects = list(self._projects.values())
+        if len(projects) < 2:
+            for project in projects:
+                project.update(changed)
+            return
+        with concurrent.futures.ThreadPoolExecutor(
+                min(len(projects), os.cpu_count() or 1)) as pool:
+            list(pool.map(lambda project: project.update(changed),
+                          projects))
+
+    def _forward(self):
+        """Sends the requests to the server, replaying the log records and
+        printing the results of the responses."""
+        if self._shutdown:
+            requests = [{"command": "shutdown"}]
+        elif self._batch is not None:
+            if self._batch == "-":
+                lines = list(sys.stdin)
+            else:
+                with open(self._batch, "r") as file:
+                    lines = list(file)
+            requests = [{"command": "batch", "lines": lines}]
+        elif self._projects:
+            requests = [{"command": "project",
+                         "path": os.path.abspath(project),
+                         "changed": self._changed}
+                        for project in self._projects]
+        else:
+            requests = [{"command": "compile",
+                         "schemas": list(self._schemas),
+                         "templates": list(self._templates)}]
+
+        log = logging.getLogger(self.__class__.__name__)
+        for request in requests:
+            try:
+                response = Codegen_Server.send(self._client, request)
+            except (OSError, ValueError) as ex:
+                log.error("Could not reach the server on %s: %s",
+                          self._client, ex)
+                self._failed += 1
+                return
+            for item in response["records"]:
+                record = logging.makeLogRecord(item)
+                if logging.getLogger(record.name).isEnabledFor(
+                        record.levelno):
+                    Record_Handler.replay([record])
+            if response["status"] == "error":
+                log.error("Request failed: %s", response["error"])
+                self._failed += 1
+            self._failed += response.get("failures", 0)
+            for status in response.get("statuses", []):
+                self._report(status)
+            if self._do_print:
+                for output in response.get("outputs", []):
+                    sys.stdout.write(output + "\n")
+
+    def _create_watcher(self):
+        if self._watch_backend != "poll":
+            if Inotify_Watcher.available():
+                return Inotify_Watcher()
+            if self._watch_backend == "inotify":
+                raise ValueError("Inotify is not available on this system.")
+        return Poll_Watcher()
 
     def process(self, schemas, templates):
         """Compiles the list of templates with the list of schemas."""
-        for schema in schemas:
-            compiler = Compiler(schema)
-            for template in templates:
-                compiled = compiler.compile(template)
+        started = FunctionResolver.begin_run()
+        if self._executor is None:
+            for schema in schemas:
+                compiler = Compiler(schema)
+                for template in templates:
+                    tokens = compiler.tokens()
+                    start_time = time.time()
+                    if self._do_print:
+                        compiler.compile_to(template, sys.stdout)
+                        sys.stdout.write("\n")
+                    else:
+                        compiler.compile(template)
+                    Stats.default().compiled(
+                        schema.path(), template.path(),
+                        time.time() - start_time, compiler.tokens() - tokens)
+            return
+
+        jobs = [Compile_Job(schema.path(), template.path(),
+                            directory=os.getcwd(), started=started)
+                for schema in schemas for template in templates]
+        for job in self._executor.map(Compile_Job.run_in_worker, jobs):
+            Record_Handler.replay(job.records)
+            if job.stats is not None:
+                Stats.default().merge(job.stats)
+            if job.error is not None:
+                raise ValueError(job.error)
+
+            if self._do_print:
+                print(job.compiled)
+
+    def process_batch(self, lines):
+        """Compiles the jobs of a batch manifest: lines with a json object
+        per job, holding the "schema" and "template" paths and optionally
+        the "out" path to write to and the "project" name. The
+        %%.project.current functions resolve as they do for a Project. Paths
+        are relative to the working directory. Schemas and templates are
+        shared by all jobs.
+
+        The status of every job is printed to stdout as a json line, in
+        manifest order: "written", "unchanged" (the out file already held
+        the output), "compiled" (no out, the output is included) or "error".
+        """
+        for status in self.batch_statuses(lines):
+            self._report(status)
+
+    def batch_statuses(self, lines, registry=None, directory=None):
+        """Compiles the jobs of a batch manifest (see process_batch),
+        yielding the status of every job in manifest order. Paths are
+        relative to the directory, the working directory by default."""
+        registry = registry if registry is not None else self._registry
+        started = FunctionResolver.begin_run()
+        registry.begin_run()
+        directory = directory or os.getcwd()
+        entries = []
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                functions = {"schema": item["schema"],
+                             "template": item["template"]}
+                if "project" in item:
+                    functions["project"] = item["project"]
+                job = Compile_Job(item["schema"], item["template"],
+                                  functions, directory, started=started)
+                if item.get("out"):
+                    job.out = File(item["out"], directory)
+            except (ValueError, KeyError, TypeError) as ex:
+                entries.append({"line": number, "status": "error",
+                                "error": "Invalid job: {!r}".format(ex)})
+                continue
+            if not File(job.schema, directory).exists():
+                status = {"schema": job.schema, "template": job.template}
+                if job.out is not None:
+                    status["out"] = job.out.path()
+                status["status"] = "error"
+                status["error"] = "Schema does not exist: {}".format(
+                    job.schema)
+                entries.append(status)
+                continue
+            entries.append(job)
+
+        jobs = [job for job in entries if isinstance(job, Compile_Job)]
+        if self._executor is None or len(jobs) < 2:
+            results = (job.execute(registry) for job in jobs)
+        else:
+            results = self._executor.map(Compile_Job.run_in_worker, jobs)
+
+        for entry in entries:
+            if not isinstance(entry, Compile_Job):
+                yield entry
+                continue
+            job = next(results)
+            Record_Handler.replay(job.records)
+            if job.stats is not None:
+                Stats.default().merge(job.stats)
+            status = {"schema": job.schema, "template": job.template}
+            if job.out is not None:
+                status["out"] = job.out.path()
+            if job.error is None and job.out is not None:
+                if job.out.digest() == job.digest:
+                    File.discard(job.tmp_path)
+                    status["status"] = "unchanged"
+                    Stats.default().count("outputs.unchanged")
+                else:
+                    try:
+                        job.out.replace(job.tmp_path)
+                        status["status"] = "written"
+                        Stats.default().count("outputs.written")
+                    except IOError as ex:
+                        job.error = "Could not write {}: {}".format(
+                            job.out.path(), ex)
+            elif job.error is None:
+                status["status"] = "compiled"
+                status["output"] = job.compiled
+            if job.error is not None:
+                status["status"] = "error"
+                status["error"] = job.error
+            else:
+                status["dependencies"] = job.dependencies
+            status["seconds"] = round(job.elapsed, 6)
+            yield status
 
-                if self._do_print:
-                    print(compiled)
+    def _report(self, status):
+        if status["status"] == "error":
+            self._failed += 1
+        print(json.dumps(status), flush=True)
 
 
 def main():
@@ -743,15 +4731,71 @@ def main():
                         format=msg_format,
                         datefmt=date_format)
 
+    def number(arg, val, kind=float):
+        """Parses the value of a numeric argument, exits with a usage error
+        if it is missing, invalid or negative."""
+        try:
+            parsed = kind(val)
+        except (TypeError, ValueError):
+            parsed = -1
+        if not 0 <= parsed < float("inf"):
+            logging.error("Invalid value for %s: %s, expected a number of "
+                          "at least 0 (%s=N)", arg, val, arg)
+            sys.exit(2)
+        return parsed
+
+    def megabytes(arg, val):
+        """Parses a size in megabytes, returns it in bytes."""
+        return int(number(arg, val) * 1024 * 1024)
+
     def parse_arg(arg, val):
         """Parses the given argument and value."""
         if arg == "-p" or arg == "--project":
             for path in val.split(","):
                 codegen.add_project(path)
         if arg == "-w" or arg == "--watch":
-            codegen.watch_project()
+            codegen.watch_project(val)
         elif arg == "--print":
             codegen.print_to_stdout()
+        elif arg == "--batch":
+            codegen.add_batch(val or "-")
+        elif arg == "--changed":
+            codegen.add_changed(val.split(","))
+        elif arg == "--serve":
+            codegen.serve(val or ".codegen.sock")
+        elif arg == "--client":
+            codegen.connect(val or ".codegen.sock")
+        elif arg == "--shutdown":
+            codegen.connect(val or ".codegen.sock", True)
+        elif arg == "-j" or arg == "--jobs":
+            codegen.set_jobs(number(arg, val, int) if val
+                             else os.cpu_count() or 1)
+        elif arg == "--cache-dir":
+            codegen.cache_dir(val or ".codegen-cache")
+        elif arg == "--stats":
+            codegen.collect_stats(val or "table")
+        elif arg == "--profile":
+            codegen.profile(val or "codegen.prof")
+        elif arg == "--compile-templates":
+            codegen.compile_templates()
+        elif arg == "--memory":
+            codegen.memory_budget(megabytes(arg, val))
+        elif arg == "--cache-ttl":
+            codegen.cache_ttl(number(arg, val))
+        elif arg == "--include-cache":
+            codegen.include_cache(megabytes(arg, val))
+        elif arg == "--render-cache":
+            codegen.render_cache(megabytes(arg, val))
+        elif arg == "--output-cache":
+            codegen.output_cache(val)
+        elif arg == "--output-cache-size":
+            codegen.output_cache_size(megabytes(arg, val))
+        elif arg == "--snapshot":
+            codegen.snapshot()
+        elif arg == "--lazy-schemas":
+            codegen.lazy_schemas(megabytes(arg, val) if val else 0)
+        elif arg == "--log-level":
+            logging.getLogger().setLevel(val.upper())
 
     for i, arg in enumerate(sys.argv):
         if i == 0:
@@ -774,7 +4818,7 @@ def main():
 
             parse_arg(arg, val)
 
-    codegen.start()
+    sys.exit(codegen.start())
 
 
 if __name__ == "__main__":